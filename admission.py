@@ -0,0 +1,235 @@
+# admission.py
+"""
+Admission control for the memory-heavy routes.
+
+A heavy request estimates the memory it needs from the size of its input
+and reserves that much from two budgets before it runs: its worker's
+(ADMISSION_WORKER_MB) and the host's (ADMISSION_HOST_MB, shared by the
+gunicorn workers through a ledger file in ADMISSION_DIR; defaults to 70% of
+physical memory). A request that does not fit waits in line for up to
+ADMISSION_TIMEOUT seconds. When the wait runs out, or ADMISSION_MAX_QUEUE
+requests are already waiting, it is refused with Saturated, which the app
+turns into 503 + Retry-After.
+
+A request is always admitted when nothing else holds the budget, so an
+estimate larger than the budget still runs, just on its own.
+"""
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import make_response, request
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines: no host-wide budget
+    fcntl = None
+
+
+MB = 2**20
+
+
+def _physical_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
+WORKER_BUDGET = int(float(os.environ.get("ADMISSION_WORKER_MB", 1024)) * MB)
+HOST_BUDGET = int(float(os.environ.get("ADMISSION_HOST_MB", 0)) * MB) or int(_physical_memory() * 0.7)
+ADMISSION_DIR = os.environ.get("ADMISSION_DIR", os.path.join(tempfile.gettempdir(), "biapp_admission"))
+TIMEOUT = float(os.environ.get("ADMISSION_TIMEOUT", 30))
+MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 8))
+RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 15))
+
+# In-memory size of a parsed input relative to its size on disk
+CSV_FACTOR = float(os.environ.get("ADMISSION_CSV_FACTOR", 6))
+XLSX_FACTOR = float(os.environ.get("ADMISSION_XLSX_FACTOR", 20))
+MIN_ESTIMATE = int(float(os.environ.get("ADMISSION_MIN_MB", 32)) * MB)
+# CSV size of a fetched report per day of its date range
+REPORT_DAY_BYTES = int(float(os.environ.get("ADMISSION_REPORT_MB_PER_DAY", 1)) * MB)
+
+# polling interval while waiting for the host budget
+HOST_POLL_SECONDS = 0.1
+
+
+class Saturated(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.retry_after = RETRY_AFTER
+
+
+def estimate(nbytes, factor=CSV_FACTOR):
+    """
+    Memory estimate for an input of `nbytes` bytes on disk.
+    """
+    return max(int(nbytes * factor), MIN_ESTIMATE)
+
+
+def file_estimate(path):
+    """
+    Memory estimate for a CSV / XLSX file (0 if it does not exist).
+    """
+    if not path or not os.path.exists(path):
+        return 0
+    return estimate(os.path.getsize(path), XLSX_FACTOR if path.endswith(".xlsx") else CSV_FACTOR)
+
+
+# -----------------------
+# Worker budget
+# -----------------------
+_cond = threading.Condition()
+_used = 0
+_waiting = 0
+
+
+def _reserve_worker(nbytes, deadline):
+    global _used, _waiting
+    with _cond:
+        if _waiting >= MAX_QUEUE:
+            raise Saturated("too many requests waiting")
+        _waiting += 1
+        try:
+            while _used and _used + nbytes > WORKER_BUDGET:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Saturated("worker memory budget exhausted")
+                _cond.wait(remaining)
+            _used += nbytes
+        finally:
+            _waiting -= 1
+
+
+def _release_worker(nbytes):
+    global _used
+    with _cond:
+        _used -= nbytes
+        _cond.notify_all()
+
+
+# -----------------------
+# Host budget
+# -----------------------
+# ledger.json maps "<pid>:<id>" to reserved bytes; entries of dead workers
+# are dropped whenever the ledger is read.
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def _ledger():
+    os.makedirs(ADMISSION_DIR, exist_ok=True)
+    path = os.path.join(ADMISSION_DIR, "ledger.json")
+    with open(os.path.join(ADMISSION_DIR, "ledger.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(path) as f:
+                    ledger = json.load(f)
+            except (OSError, ValueError):
+                ledger = {}
+            ledger = {key: value for key, value in ledger.items() if _alive(int(key.split(":")[0]))}
+            yield ledger
+            with open(path + ".tmp", "w") as f:
+                json.dump(ledger, f)
+            os.replace(path + ".tmp", path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _reserve_host(key, nbytes, deadline):
+    while True:
+        with _ledger() as ledger:
+            used = sum(ledger.values())
+            if not used or used + nbytes <= HOST_BUDGET:
+                ledger[key] = nbytes
+                return
+        if time.monotonic() >= deadline:
+            raise Saturated("host memory budget exhausted")
+        time.sleep(HOST_POLL_SECONDS)
+
+
+def _release_host(key):
+    with _ledger() as ledger:
+        ledger.pop(key, None)
+
+
+def host_budget_enabled():
+    return fcntl is not None and HOST_BUDGET > 0
+
+
+# -----------------------
+# Reservations
+# -----------------------
+def acquire(nbytes):
+    """
+    Reserve `nbytes` from the worker and host budgets, waiting up to
+    TIMEOUT seconds. Returns a callable that releases the reservation.
+    """
+    nbytes = min(nbytes, WORKER_BUDGET)
+    deadline = time.monotonic() + TIMEOUT
+
+    _reserve_worker(nbytes, deadline)
+    if not host_budget_enabled():
+        return functools.partial(_release_worker, nbytes)
+
+    key = f"{os.getpid()}:{uuid.uuid4().hex}"
+    try:
+        _reserve_host(key, min(nbytes, HOST_BUDGET), deadline)
+    except BaseException:
+        _release_worker(nbytes)
+        raise
+
+    def release():
+        try:
+            _release_host(key)
+        finally:
+            _release_worker(nbytes)
+    return release
+
+
+def limit(estimate_fn):
+    """
+    Decorate a heavy view: reserve estimate_fn() bytes until its response
+    is closed (so streamed responses keep their reservation while they run).
+    An estimate of 0 skips admission control.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            nbytes = estimate_fn()
+            if not nbytes:
+                return view(*args, **kwargs)
+
+            started = time.perf_counter()
+            try:
+                release = acquire(nbytes)
+            except Saturated:
+                metrics.ADMISSION_REJECTED.inc(endpoint=request.endpoint)
+                raise
+            metrics.ADMISSION_WAIT.observe(time.perf_counter() - started, endpoint=request.endpoint)
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                release()
+                raise
+            response.call_on_close(release)
+            return response
+        return wrapper
+    return decorator
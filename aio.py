@@ -0,0 +1,117 @@
+# aio.py
+"""
+Async versions of the ion / Key Vault calls made while fetching reports, so
+the network waits of one request overlap instead of running back to back:
+both token refreshes (Key Vault get, ion OAuth, Key Vault set) and both
+report downloads of run_awstool are in flight at the same time.
+
+Enabled with ASYNC_IO=1; needs aiohttp, which the async Azure SDK clients
+use as their transport too. Entry points are plain functions that run their
+coroutines with asyncio.run, so the Flask views stay synchronous. The ion and
+Key Vault timeouts of resilience apply; retries and circuit breaking are
+only done on the synchronous path.
+"""
+import asyncio
+import json
+import os
+import time
+import urllib.parse
+
+import metrics
+import prefetch
+import resilience
+
+try:
+    import aiohttp
+    from azure.identity.aio import DefaultAzureCredential
+    from azure.keyvault.secrets.aio import SecretClient
+except ImportError:
+    aiohttp = None
+
+
+ASYNC_IO = os.environ.get("ASYNC_IO") == "1"
+
+if ASYNC_IO and aiohttp is None:
+    print("ASYNC_IO=1 but aiohttp is not installed: external calls stay synchronous")
+
+
+def enabled():
+    return ASYNC_IO and aiohttp is not None
+
+
+async def access_token(session, ion_url, secret_client, secret_id, refresh=False):
+    """
+    Async counterpart of awstool.access_token (and, with refresh=True, of
+    awstool.refresh_token).
+    """
+    with metrics.dependency("keyvault", "get_secret"):
+        secret = await secret_client.get_secret(secret_id)
+    secret_json = json.loads(secret.value)
+    if not refresh:
+        fresh = prefetch.fresh_access_key(secret_json)
+        if fresh:
+            return fresh
+    old_refresh = secret_json["refresh_key"]
+
+    body = urllib.parse.urlencode({
+        "grant_type": "refresh_token",
+        "refresh_token": old_refresh
+    })
+    with metrics.dependency("ion", "oauth_token"):
+        async with session.post(f"{ion_url}/oauth/token", data=body,
+                                headers={"Content-Type": "application/x-www-form-urlencoded"}) as resp:
+            resp_json = json.loads(await resp.text())
+
+    new_refresh = resp_json["refresh_token"]
+    new_access = resp_json["access_token"]
+
+    with metrics.dependency("keyvault", "set_secret"):
+        await secret_client.set_secret(
+            secret_id,
+            json.dumps({"refresh_key": new_refresh, "access_key": new_access, "refreshed_at": int(time.time())})
+        )
+
+    return new_access
+
+
+async def fetch_report(session, ion_url, secret_client, secret_id, path, payload):
+    """
+    Get a token, then download one reportDataCsv export.
+    Returns the HTTP status and the response body.
+    """
+    for refresh in (False, True):
+        token = await access_token(session, ion_url, secret_client, secret_id, refresh)
+
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
+        with metrics.dependency("ion", "report_download"):
+            async with session.post(f"{ion_url}{path}", data=json.dumps(payload), headers=headers) as resp:
+                data = await resp.text()
+                status = resp.status
+        # a rejected stored token is refreshed once
+        if status != 401:
+            break
+
+    metrics.payload("ion_report", len(data))
+    return status, data
+
+
+async def fetch_all(ion_url, vault_url, reports):
+    # the clients are bound to the running loop, so they are opened per call
+    credential = DefaultAzureCredential()
+    ion_timeout = aiohttp.ClientTimeout(sock_connect=resilience.timeout("ion"), sock_read=resilience.timeout("ion"))
+    async with credential, \
+            SecretClient(vault_url=vault_url, credential=credential,
+                         **resilience.client_options("keyvault")) as secret_client, \
+            aiohttp.ClientSession(timeout=ion_timeout) as session:
+        return await asyncio.gather(*(
+            fetch_report(session, ion_url, secret_client, secret_id, path, payload)
+            for secret_id, path, payload in reports
+        ))
+
+
+def fetch_reports(ion_url, vault_url, reports):
+    """
+    Download the (secret_id, path, payload) reports concurrently.
+    Returns a (status, body) pair per report, in order.
+    """
+    return asyncio.run(fetch_all(ion_url, vault_url, reports))
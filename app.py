@@ -1,15 +1,25 @@
-import json, os, io, traceback, uuid
+import json, os, io, traceback, uuid, time, tempfile, gzip, shutil, zlib, mimetypes
 from io import BytesIO
-from flask import Flask, request, send_file, jsonify, render_template, send_from_directory,Response
+from flask import Flask, Request, request, send_file, jsonify, render_template, send_from_directory,Response, g, make_response
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import ClosingIterator
+import numpy as np
 import pandas as pd
 from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobServiceClient, ContentSettings
 from dotenv import load_dotenv
 from awstool import run_awstool, apply_credit_adjustments,apply_po_adjustments,apply_exception,consolidation, amend_sap_consolidation, get_sap_ids
-from awstool import last_country, last_start_date, last_end_date, sap_consolidation_csv
+from awstool import run_pipeline, parse_period, read_adjustment_file, InputError, EXCEPTION_HEADERS, CREDIT_HEADERS, PO_HEADERS
+from awstool import compact_exceptions, compact_credits, compact_po
+from awstool import last_country, last_start_date, last_end_date, sap_consolidation_csv, report_csv, working_report_path
 import csv
-
-sap_consolidation_bytes = None
+import x2cf
+import metrics
+import profiling
+import admission
+import resilience
+import prefetch
+import memory
 
 
 load_dotenv() 
@@ -24,12 +34,284 @@ CONTAINER_NAME = os.environ.get("CONTAINER_NAME")
 #STORAGE_ACCOUNT_URL = f"https://awstoolstorage.blob.core.windows.net"
 #CONTAINER_NAME = "billing-report-uploaded"
 
-blob_service_client = BlobServiceClient(account_url=STORAGE_ACCOUNT_URL, credential=DefaultAzureCredential())
+# A connection string (e.g. Azurite's) takes precedence over the managed identity
+if os.environ.get("AZURE_STORAGE_CONNECTION_STRING"):
+    blob_service_client = BlobServiceClient.from_connection_string(
+        os.environ["AZURE_STORAGE_CONNECTION_STRING"], **resilience.client_options("blob"))
+else:
+    blob_service_client = BlobServiceClient(account_url=STORAGE_ACCOUNT_URL, credential=DefaultAzureCredential(),
+                                            **resilience.client_options("blob"))
+
+# tokens, EMEA mapping and end-customer IDs are refreshed ahead of use (PREFETCH=1)
+prefetch.start()
+
+
+# ---------- Metrics ----------
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if request.content_length:
+        metrics.payload("request_body", request.content_length)
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - started,
+                                        route=route, method=request.method, status=response.status_code)
+        metrics.flush()
+    return response
+
+
+# ---------- Memory ----------
+# Heavy routes give their memory back once the response has been sent
+# (streamed responses included); see memory.release.
+HEAVY_ENDPOINTS = {"awstool", "upload_credits", "upload_exception", "run_consolidation", "upload_po",
+                   "pipeline_api", "upload_file", "process_file"}
+
+
+@app.after_request
+def release_memory(response):
+    if request.endpoint in HEAVY_ENDPOINTS:
+        response.call_on_close(memory.release)
+    return response
+
+
+# ---------- Profiling (opt-in) ----------
+@app.before_request
+def start_profiling():
+    if profiling.wanted(request):
+        profile = profiling.RequestProfile(request)
+        if profile.start():
+            g.profile = profile
+        else:
+            app.logger.info("Not profiling %s: another request is being profiled", request.path)
+
+
+@app.after_request
+def finish_profiling(response):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.stop()
+        try:
+            profile.save(response.status_code, blob_service_client)
+            response.headers["X-Profile-Id"] = profile.request_id
+        except Exception as e:
+            app.logger.error("Could not save profile %s: %s", profile.request_id, e)
+    return response
+
+
+@app.teardown_request
+def stop_profiling(exc):
+    # unhandled errors skip after_request: still stop the profiler
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.stop()
+        try:
+            profile.save(500, blob_service_client)
+        except Exception as e:
+            app.logger.error("Could not save profile %s: %s", profile.request_id, e)
+
+
+# ---------- Upload limits ----------
+# Uploaded files stay in memory up to UPLOAD_SPOOL_MB and are spooled to a
+# temporary file beyond that. Requests bigger than MAX_UPLOAD_MB (or
+# MAX_ADJUSTMENT_UPLOAD_MB for the adjustment routes) are rejected with 413
+# from their Content-Length, before the body is read.
+UPLOAD_SPOOL_BYTES = int(float(os.environ.get("UPLOAD_SPOOL_MB", 4)) * 2**20)
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MAX_UPLOAD_MB", 512)) * 2**20)
+MAX_ADJUSTMENT_UPLOAD_BYTES = int(float(os.environ.get("MAX_ADJUSTMENT_UPLOAD_MB", 50)) * 2**20)
+
+ADJUSTMENT_ENDPOINTS = {"upload_exception", "upload_credits", "upload_po", "amend_sap_consolidation_route"}
+# routes that answer with the awstool page rather than JSON
+AWSTOOL_FORM_ENDPOINTS = ADJUSTMENT_ENDPOINTS | {"awstool", "run_consolidation"}
+
+
+class SpooledRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, mode="rb+")
+
+
+class ClosingResponse(Response):
+    # send_file responses go to the server as they are, which skips their
+    # call_on_close callbacks (admission release, memory.release): run them
+    # when the server closes the file instead
+    def get_app_iter(self, environ):
+        app_iter = super().get_app_iter(environ)
+        if self.direct_passthrough and self._on_close:
+            return ClosingIterator(app_iter, self._on_close)
+        return app_iter
+
+
+app.request_class = SpooledRequest
+app.response_class = ClosingResponse
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+
+
+def upload_limit(endpoint):
+    return MAX_ADJUSTMENT_UPLOAD_BYTES if endpoint in ADJUSTMENT_ENDPOINTS else MAX_UPLOAD_BYTES
+
+
+@app.before_request
+def check_upload_size():
+    if (request.content_length or 0) > upload_limit(request.endpoint):
+        raise RequestEntityTooLarge()
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    message = f"Upload too large: the limit is {upload_limit(request.endpoint) / 2**20:g} MB."
+    if request.endpoint in AWSTOOL_FORM_ENDPOINTS:
+        return render_template("awstool.html", result={"error": message}), 413
+    return jsonify({"error": message}), 413
+
+
+# ---------- Compression ----------
+# Reports and FTP files are stored gzip-compressed in Blob, with
+# Content-Encoding: gzip on the blob (BLOB_GZIP=0 stores them as is), and
+# downloads are sent gzip-encoded to clients that accept it.
+BLOB_GZIP = os.environ.get("BLOB_GZIP", "1") == "1"
+GZIP_LEVEL = 6
+
+
+def gzip_file(src):
+    """
+    Gzip a binary file object into a spooled temporary file.
+    Returns the file (rewound) and its size.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as gz:
+        shutil.copyfileobj(src, gz, 2**20)
+    size = out.tell()
+    out.seek(0)
+    return out, size
+
+
+def accepts_gzip():
+    return request.accept_encodings["gzip"] > 0
+
+
+def store_blob(name, stream, size, content_type, content_encoding=None):
+    """
+    Upload a file object to CONTAINER_NAME.
+    """
+    blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=name)
+    start = stream.tell()
+
+    def upload():
+        # a retried upload starts over from the beginning of the data
+        stream.seek(start)
+        blob_client.upload_blob(
+            stream, length=size, overwrite=True,
+            content_settings=ContentSettings(content_type=content_type, content_encoding=content_encoding)
+        )
+
+    resilience.call("blob", "upload", upload)
+    metrics.payload("blob_upload", size)
+
+
+def send_download(stream, download_name, mimetype, gzipped=False):
+    """
+    Send a file object as an attachment, gzip-encoded if the client accepts
+    it. `gzipped` tells whether the stream already holds gzip data.
+    """
+    source = stream
+    if accepts_gzip():
+        if not gzipped:
+            with source:
+                stream, _ = gzip_file(source)
+    elif gzipped:
+        stream = gzip.GzipFile(fileobj=source, mode="rb")
+
+    response = send_file(stream, mimetype=mimetype, as_attachment=True, download_name=download_name)
+    # send_file closes what it sends, but a GzipFile leaves the file it wraps open
+    response.call_on_close(source.close)
+    if accepts_gzip():
+        response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def recode_chunks(chunks, gzipped, to_gzip):
+    """
+    Yield byte chunks gzip-encoded if `to_gzip`, plain otherwise;
+    `gzipped` tells whether the chunks already hold gzip data.
+    """
+    if gzipped == to_gzip:
+        yield from chunks
+        return
+    if to_gzip:
+        codec = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        convert, finish = codec.compress, codec.flush
+    else:
+        codec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        convert, finish = codec.decompress, codec.flush
+    for chunk in chunks:
+        data = convert(chunk)
+        if data:
+            yield data
+    data = finish()
+    if data:
+        yield data
+
+
+# ---------- Admission control ----------
+# Memory estimates for the heavy routes, from the size of what they load.
+def report_estimate():
+    """
+    The working report plus any uploaded adjustment file.
+    """
+    if request.method != "POST" and request.endpoint == "awstool":
+        return 0
+    return admission.file_estimate(working_report_path()) + admission.estimate(request.content_length or 0)
+
+
+def pipeline_estimate():
+    """
+    The report of the requested date range plus any uploaded adjustment
+    file; a request without a valid date range is refused by the view.
+    """
+    params = request.get_json(silent=True) if request.is_json else request.form
+    uploads = admission.estimate(request.content_length or 0)
+    try:
+        start_dt, end_dt = parse_period(params.get("start_date"), params.get("end_date"))
+    except (AttributeError, InputError):
+        return uploads
+    days = (end_dt - start_dt).days + 1
+    return admission.estimate(days * admission.REPORT_DAY_BYTES) + uploads
+
+
+def upload_estimate():
+    return admission.estimate(request.content_length or 0, admission.XLSX_FACTOR)
+
+
+def x2cf_estimate():
+    sources = memory.retained.get(x2cf_key(request.form.get("upload_id")), [])
+    return sum(admission.file_estimate(source["path"]) for source in sources)
+
+
+@app.errorhandler(admission.Saturated)
+def server_busy(e):
+    message = "The server is busy with other large requests, please retry shortly."
+    if request.endpoint in AWSTOOL_FORM_ENDPOINTS:
+        response = make_response(render_template("awstool.html", result={"error": message}), 503)
+    else:
+        response = make_response(jsonify({"error": message}), 503)
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(resilience.metrics_lines() + memory.metrics_lines()),
+                    mimetype="text/plain; version=0.0.4")
+
 
 # ---------- STEP 1 ----------
 @app.route("/awstool", methods=["GET", "POST"])
+@admission.limit(report_estimate)
 def awstool():
     result = None
     if request.method == "POST":
@@ -37,21 +319,15 @@ def awstool():
         start_date = request.form.get("start_date")
         end_date = request.form.get("end_date")
 
+        # run_awstool saves the metadata used by the later steps
         result = run_awstool(country, start_date, end_date)
-        if "error" not in result:
-            # Save metadata for later use in download
-            with open("metadata.json", "w") as f:
-                json.dump({
-                    "country": country,
-                    "start_date": start_date,
-                    "end_date": end_date
-                }, f)
 
     return render_template("awstool.html", result=result)
 
 
 # ---------- STEP 2b ----------
 @app.route("/upload_credits", methods=["POST"])
+@admission.limit(report_estimate)
 def upload_credits():
     if "file" not in request.files:
         return render_template("awstool.html", result={"error": "No file uploaded"})
@@ -66,6 +342,7 @@ def upload_credits():
 
 # ---------- STEP 2a ----------
 @app.route("/upload_exception", methods=["POST"])
+@admission.limit(report_estimate)
 def upload_exception():
     if "file" not in request.files:
         return render_template("awstool.html", result={"error": "No file uploaded"})
@@ -80,6 +357,7 @@ def upload_exception():
 
 # ---------- STEP 3 ----------
 @app.route("/consolidation", methods=["GET", "POST"])
+@admission.limit(report_estimate)
 def run_consolidation():
     result = consolidation()
     return render_template("awstool.html", result=result)
@@ -87,6 +365,7 @@ def run_consolidation():
 
 # ---------- STEP 2c ----------
 @app.route("/upload_po", methods=["POST"])
+@admission.limit(report_estimate)
 def upload_po():
     if "file" not in request.files:
         return render_template("awstool.html", result={"error": "No file uploaded"})
@@ -99,6 +378,96 @@ def upload_po():
     return render_template("awstool.html", result=result)
 
 
+# ---------- Pipeline API ----------
+# Steps 1-3 in one call. Accepts either multipart form fields (country,
+# start_date, end_date, format) with optional files "exceptions", "credits"
+# and "po", or a JSON body with the same fields and the adjustment files as
+# lists of row objects. The consolidated report is returned as JSON (default)
+# or as a csv / xlsx / parquet download.
+PIPELINE_INPUTS = {
+    "exceptions": (EXCEPTION_HEADERS, compact_exceptions),
+    "credits": (CREDIT_HEADERS, compact_credits),
+    "po": (PO_HEADERS, compact_po),
+}
+
+
+def _pipeline_inputs():
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            raise InputError("The JSON body must be an object")
+        adjustments = {}
+        for name, (expected_headers, _) in PIPELINE_INPUTS.items():
+            if body.get(name) is not None:
+                if not (isinstance(body[name], list) and all(isinstance(row, dict) for row in body[name])):
+                    raise InputError(f"{name} must be a list of row objects")
+                # keep the upload column order whatever the key order in the rows
+                df = pd.DataFrame(body[name])
+                adjustments[name] = df.reindex(columns=expected_headers) if set(df.columns) == set(expected_headers) else df
+        return body, adjustments
+
+    adjustments = {}
+    for name, (expected_headers, compact) in PIPELINE_INPUTS.items():
+        file = request.files.get(name)
+        if file is not None and file.filename:
+            read_csv_kwargs = {"encoding": "latin1"} if name == "po" else {}
+            adjustments[name] = read_adjustment_file(file, expected_headers, compact, **read_csv_kwargs)
+    return request.form, adjustments
+
+
+@app.route("/api/pipeline", methods=["POST"])
+@admission.limit(pipeline_estimate)
+def pipeline_api():
+    try:
+        params, adjustments = _pipeline_inputs()
+        output_format = params.get("format", "json")
+        if not isinstance(output_format, str) or (output_format != "json" and output_format not in x2cf.output_formats):
+            return jsonify({"error": f"Invalid output format: {output_format}"}), 400
+        if not all(isinstance(params.get(field), str) and params.get(field)
+                   for field in ("country", "start_date", "end_date")):
+            return jsonify({"error": "country, start_date and end_date are required"}), 400
+        parse_period(params["start_date"], params["end_date"])
+
+        with metrics.stage("pipeline"):
+            result = run_pipeline(
+                params["country"], params["start_date"], params["end_date"],
+                exceptions=adjustments.get("exceptions"),
+                credits=adjustments.get("credits"),
+                po_numbers=adjustments.get("po"),
+            )
+        report = result.pop("report")
+
+        if output_format == "json":
+            result["seller_sum"] = float(result["seller_sum"])
+            result["customer_sum"] = float(result["customer_sum"])
+            result["rows"] = report.astype(object).where(report.notna(), None).to_dict("records")
+            return jsonify(result)
+
+        output_cfg = x2cf.output_formats[output_format]
+        download_name = f"AWS_Consolidated_{params['country']}_from_{params['start_date'].replace('-', '')}" \
+                        f"_to_{params['end_date'].replace('-', '')}.{output_format}"
+        if output_format == "csv":
+            return Response(
+                x2cf.iter_csv(report),
+                mimetype=output_cfg["mimetype"],
+                headers={"Content-Disposition": f"attachment; filename={download_name}"}
+            )
+        if output_format == "parquet":
+            try:
+                output = x2cf.write_parquet(report)
+            except ImportError:
+                return jsonify({"error": "Parquet output is not available on this server"}), 400
+        else:
+            output = x2cf.write_xlsx(report)
+        return send_file(output, mimetype=output_cfg["mimetype"], as_attachment=True, download_name=download_name)
+
+    except InputError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+
+
 # ---------- STEP 4 ----------
 @app.route("/download_csv")
 def download_csv():
@@ -119,26 +488,24 @@ def download_csv():
         
         filename = f"AWS_Billing_Report_{country}_from_{start_fmt}_to_{end_fmt}_{unique_id}.csv"
 
-        # --- Load CSV into memory ---
-        with open("latest_report.csv", "rb") as f:
-            file_bytes = io.BytesIO(f.read())
-
         # --- Upload to Azure Blob ---
-        file_bytes.seek(0)  # reset pointer before upload
-        blob_client = blob_service_client.get_blob_client(
-            container=CONTAINER_NAME,
-            blob=filename
-        )
-        blob_client.upload_blob(file_bytes, overwrite=True)
+        if BLOB_GZIP:
+            # compressed once, for the blob and for the response
+            with open(report_csv, "rb") as f:
+                stream, size = gzip_file(f)
+            store_blob(filename, stream, size, "text/csv", content_encoding="gzip")
+            stream.seek(0)
+        else:
+            stream = open(report_csv, "rb")
+            try:
+                store_blob(filename, stream, os.path.getsize(report_csv), "text/csv")
+            except Exception:
+                stream.close()
+                raise
+            stream.seek(0)
 
         # --- Return file to user ---
-        file_bytes.seek(0)  # reset pointer again for download
-        return send_file(
-            file_bytes,
-            mimetype="text/csv",
-            as_attachment=True,
-            download_name=filename
-        )
+        return send_download(stream, filename, "text/csv", gzipped=BLOB_GZIP)
 
     except Exception as e:
         return f"Error: {str(e)}", 500
@@ -162,18 +529,8 @@ def download_local_csv():
 
         filename = f"AWS_Billing_Raw_{country}_from_{start_fmt}_to_{end_fmt}.csv"
 
-        # --- Load CSV into memory ---
-        with open("latest_report.csv", "rb") as f:
-            file_bytes = io.BytesIO(f.read())
-
         # --- Return file to user (no Blob upload) ---
-        file_bytes.seek(0)
-        return send_file(
-            file_bytes,
-            mimetype="text/csv",
-            as_attachment=True,
-            download_name=filename
-        )
+        return send_download(open(report_csv, "rb"), filename, "text/csv")
 
     except Exception as e:
         return f"Error: {str(e)}", 500
@@ -261,8 +618,9 @@ def download_template(template):
 def index():
     return render_template('index.html')
 
-@app.route('/x2cf')
-def x2cf():
+# the view is not named x2cf so it does not shadow the x2cf module
+@app.route('/x2cf', endpoint='x2cf')
+def x2cf_page():
     return render_template('x2cf.html')
 
 @app.route('/consolidate')
@@ -280,35 +638,23 @@ def favicon():
     )
 
 @app.route('/upload', methods=['POST'])
+@admission.limit(upload_estimate)
 def upload_file():
     try:
         uploaded = request.files.get('file')
         if not uploaded:
             return jsonify({'error': 'No file uploaded'}), 400
 
-        raw_bytes = uploaded.read()
-        df = pd.read_excel(BytesIO(raw_bytes),
+        # read straight from the spooled upload, without another copy in memory
+        df = pd.read_excel(uploaded.stream,
                            engine='openpyxl',
                            dtype=str)
 
         # transform_sap may raise ValueError
-        transformed_df = transform_sap(df)
-
-        buffer = BytesIO()
-        for line in transformed_df["merged"]:
-            buffer.write((line + "\n").encode("utf-8"))
-        csv_bytes = buffer.getvalue()
-
         base = uploaded.filename.rsplit('.', 1)[0]
-        transformed_name = f"{base}_FTP.csv"
+        download_url = store_ftp(df, f"{base}_FTP.csv")
 
-        blob = blob_service_client.get_blob_client(
-            container=CONTAINER_NAME,
-            blob=transformed_name
-        )
-        blob.upload_blob(csv_bytes, overwrite=True)
-
-        return jsonify({'download_url': f'/download/{transformed_name}'}), 200
+        return jsonify({'download_url': download_url}), 200
 
     except ValueError:
         # Specific friendly message just for this route
@@ -329,13 +675,60 @@ def download_file(filename):
         container=CONTAINER_NAME,
         blob=filename
     )
-    data = blob_client.download_blob().readall()
-    return send_file(
-        BytesIO(data),
-        as_attachment=True,
-        download_name=filename
-    )
 
+    # the raw bytes: gzip blobs are passed on compressed when possible
+    downloader = resilience.call("blob", "download", lambda: blob_client.download_blob(decompress=False))
+    metrics.payload("blob_download", downloader.size)
+    gzipped = downloader.properties.content_settings.content_encoding == "gzip"
+    to_gzip = accepts_gzip()
+
+    # chunks go to the client as they arrive instead of being read in full
+    response = Response(
+        recode_chunks(downloader.chunks(), gzipped, to_gzip),
+        mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+    )
+    response.headers.set("Content-Disposition", "attachment", filename=filename)
+    if gzipped == to_gzip:
+        response.content_length = downloader.size
+    if to_gzip:
+        response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def ftp_file(df):
+    """
+    The FTP file of an SAP upload frame (see transform_sap), in a spooled
+    temporary file positioned at the start.
+    """
+    with metrics.stage("transform_sap"):
+        transformed_df = transform_sap(df)
+    metrics.rows("transform_sap", len(transformed_df))
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    for line in transformed_df["merged"]:
+        buffer.write((line + "\n").encode("utf-8"))
+    buffer.seek(0)
+    return buffer
+
+
+def store_ftp(df, transformed_name):
+    """
+    Store the FTP file of an SAP upload frame in Blob; returns its download URL.
+    """
+    buffer = ftp_file(df)
+    if BLOB_GZIP:
+        compressed, compressed_size = gzip_file(buffer)
+        buffer.close()
+        store_blob(transformed_name, compressed, compressed_size, "text/csv", content_encoding="gzip")
+        compressed.close()
+    else:
+        buffer.seek(0, io.SEEK_END)
+        size = buffer.tell()
+        buffer.seek(0)
+        store_blob(transformed_name, buffer, size, "text/csv")
+        buffer.close()
+    return f'/download/{transformed_name}'
 
     
 def transform_sap(df: pd.DataFrame) -> pd.DataFrame:
@@ -378,61 +771,89 @@ def transform_sap(df: pd.DataFrame) -> pd.DataFrame:
     .agg(";".join, axis=1)
     )
 
-    header_out = header_df[["ID", "merged"]]
-    line_out   = line_df[["ID", "merged"]]
+    # each header followed by its lines, in file order; lines without a header are dropped
+    header_position = pd.Series(np.arange(len(header_df)), index=header_df["ID"])
+    line_df = line_df[line_df["ID"].notna()]
+    line_position = line_df["ID"].map(header_position[header_position.index.notna()])
+    line_df = line_df[line_position.notna()]
+    line_position = line_position.dropna().to_numpy(dtype="int64")
 
-    rows = []
-    for _, hdr in header_out.iterrows():
-        rows.append(hdr.to_dict())
-        matching = line_out[line_out["ID"] == hdr["ID"]]
-        for _, ln in matching.iterrows():
-            rows.append(ln.to_dict())
+    position = np.concatenate([np.arange(len(header_df)), line_position])
+    is_line = np.concatenate([np.zeros(len(header_df), dtype="int8"), np.ones(len(line_df), dtype="int8")])
+    merged = np.concatenate([header_df["merged"].to_numpy(), line_df["merged"].to_numpy()])
 
-    combined = pd.DataFrame(rows, columns=["merged"])
+    # lexsort is stable, so lines keep their order within a header
+    combined = pd.DataFrame({"merged": merged[np.lexsort((is_line, position))]})
     return combined
 
+
+def x2cf_key(upload_id):
+    return f"x2cf:{upload_id}"
+
+
 # upload endpoint
 @app.route('/x2cf_upload_file', methods=['POST'])
 def x2cf_upload_file():
-    global dfs
-    dfs = []
+    # the client's previous upload is replaced; other clients' uploads stay
+    if request.form.get('upload_id'):
+        memory.retained.discard(x2cf_key(request.form['upload_id']))
 
     files = request.files.getlist('file')
     if not files:
         return jsonify({'error': 'No files uploaded'}), 400
 
+    for file in files:
+        if not x2cf.is_supported(file.filename):
+            return jsonify({'error': f'Invalid file format: {file.filename}'}), 400
+
+    preview_rows = request.form.get('preview_rows', 0, type=int)
+
     columns = set()
 
     try:
-        for file in files:
-            if file.filename.endswith('.csv'):
-                df = pd.read_csv(file, dtype={"Payer Account ID": 'string',
-                                              "Cloud Account Number": 'string'})
-            elif file.filename.endswith('.xlsx'):
-                df = pd.read_excel(file, dtype={"Payer Account ID": 'string',
-                                                 "Cloud Account Number": 'string'})
-            else:
-                return jsonify({'error': f'Invalid file format: {file.filename}'}), 400
-
-            country = file.filename[:2].upper()
-            df['Created Country'] = country
-
-            dfs.append(df)
-            columns.update(df.columns.tolist())
-
-        return jsonify(sorted(columns))
+        # only headers (and an optional preview) are read here, in this process; /process parses the data
+        x2cf_sources = [x2cf.save_upload(file) for file in files]
+        # kept under a token the client sends to /process, until replaced or
+        # evicted by size or age (the files are deleted then)
+        upload_id = uuid.uuid4().hex
+        memory.retained.put(x2cf_key(upload_id), x2cf_sources,
+                            size=sum(os.path.getsize(source["path"]) for source in x2cf_sources),
+                            on_evict=x2cf.discard_sources)
+        results = x2cf.map_sources(x2cf.read_header, x2cf_sources, preview_rows, processes=False)
+
+        errors = [{'filename': r['filename'], 'error': r['error']} for r in results if 'error' in r]
+        if errors:
+            memory.retained.discard(x2cf_key(upload_id))
+            for err in errors:
+                app.logger.error("Error parsing %s: %s", err['filename'], err['error'])
+            return jsonify({'error': 'Failed to process files', 'files': errors}), 500
+
+        timings = []
+        for r in results:
+            columns.update(r['value']['columns'])
+            file_info = {'filename': r['filename'],
+                         'seconds': round(r['value']['seconds'], 3)}
+            if preview_rows:
+                file_info['preview'] = r['value']['preview']
+            timings.append(file_info)
+
+        return jsonify({'upload_id': upload_id, 'columns': sorted(columns), 'files': timings})
     except Exception as e:
         app.logger.error("Error during file upload: %s", e)
         return jsonify({'error': 'Failed to process files'}), 500
 
 @app.route('/process', methods=['POST'])
+@admission.limit(x2cf_estimate)
 def process_file():
-    global dfs
     try:
         group_by_columns = request.form.getlist('group_by')
         aggregations     = request.form.getlist('aggregations')
         order_by_column  = request.form.get('order_by')
         column_order     = request.form.getlist('column_order')
+        output_format    = request.form.get('format', 'xlsx')
+
+        if output_format not in x2cf.output_formats:
+            return jsonify({'error': f'Invalid output format: {output_format}'}), 400
 
         # build the aggregation dict
         agg_dict = {}
@@ -442,8 +863,21 @@ def process_file():
                 if agg == 'sum':
                     agg_dict[col] = 'sum'
 
-        combined = pd.concat(dfs, ignore_index=True)
-        grouped  = combined.groupby(group_by_columns).agg(agg_dict).reset_index()
+        # the files stay on disk while they are read, even if evicted meanwhile
+        with memory.retained.using(x2cf_key(request.form.get('upload_id'))) as sources:
+            # e.g. no token, uploaded to another worker, or expired
+            if not sources:
+                return jsonify({'error': 'No uploaded files, please upload again'}), 400
+
+            # partial sums per file/chunk, merged - the inputs are never concatenated
+            with metrics.stage("x2cf_aggregate"):
+                grouped, errors = x2cf.aggregate(sources, group_by_columns, agg_dict)
+        if errors:
+            for err in errors:
+                app.logger.error("Error aggregating %s: %s", err['filename'], err['error'])
+            return jsonify({'error': 'Failed to process data', 'files': errors}), 500
+
+        metrics.rows("x2cf_aggregate", len(grouped))
 
         # reorder columns if requested
         if column_order:
@@ -453,17 +887,30 @@ def process_file():
         if order_by_column:
             grouped = grouped.sort_values(by=order_by_column)
 
-        # write to excel in-memory
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            grouped.to_excel(writer, index=False)
-        output.seek(0)
+        output_cfg = x2cf.output_formats[output_format]
+
+        # csv is streamed straight to the client
+        if output_format == 'csv':
+            return Response(
+                x2cf.iter_csv(grouped),
+                mimetype=output_cfg['mimetype'],
+                headers={'Content-Disposition': f"attachment; filename={output_cfg['download_name']}"}
+            )
+
+        # xlsx / parquet are spooled to a temporary file, not built in memory
+        if output_format == 'parquet':
+            try:
+                output = x2cf.write_parquet(grouped)
+            except ImportError:
+                return jsonify({'error': 'Parquet output is not available on this server'}), 400
+        else:
+            output = x2cf.write_xlsx(grouped)
 
         return send_file(
             output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            mimetype=output_cfg['mimetype'],
             as_attachment=True,
-            download_name='grouped_data.xlsx'
+            download_name=output_cfg['download_name']
         )
     except Exception as e:
         app.logger.error("Error during processing: %s", e)
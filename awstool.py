@@ -1,16 +1,24 @@
 # awstool.py
-import io, os
+import io, os, re, shutil, time
+import csv
 import json
 import http.client
 import urllib.parse
 import pandas as pd
+from openpyxl import load_workbook
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
 from azure.keyvault.secrets import SecretClient
 import traceback
 import numpy as np
 import pyodbc
+import metrics
+import resilience
+import prefetch
+import aio
+import consolidation_sql
 
 
 
@@ -24,13 +32,114 @@ last_end_date = None
 
 # Global CSV path
 sap_consolidation_csv = "sap_consolidation.csv"
+report_csv = "latest_report.csv"
+detail_csv = "latest_detail.csv"
+consolidation_state_file = "consolidation_state.pkl"
+consolidation_dirty_file = "consolidation_dirty.json"
+
+
+class InputError(ValueError):
+    """
+    A problem with user input (unsupported country, bad file or header),
+    reported back as a plain error message.
+    """
+
+
+# -----------------------
+# Join keys
+# -----------------------
+# Accounts and SAP IDs are carried as int64 internally so merges and map()
+# lookups hash integers. Accounts are padded back to 12 characters only when
+# a report is written out.
+ACCOUNT_WIDTH = 12
+MISSING_KEY = -1
+UNKNOWN_SAP_ID = 999999
+
+
+def to_key(values, default=MISSING_KEY):
+    """
+    Parse account numbers or SAP IDs into int64 keys.
+    Empty or invalid values become `default`.
+    """
+    return pd.to_numeric(pd.Series(values), errors="coerce").fillna(default).astype("int64")
+
+
+def format_account(keys):
+    """
+    Render int64 account keys as 12-character zero-padded strings.
+    """
+    return keys.astype(str).str.zfill(ACCOUNT_WIDTH).where(keys != MISSING_KEY, "")
+
+
+# -----------------------
+# Money
+# -----------------------
+# Seller and Customer Cost are carried as int64 cents (nullable, so missing
+# costs stay missing) and only turned back into amounts when a report is
+# written out. Sums and credit deductions are then exact.
+MONEY_COLUMNS = ["Seller Cost", "Customer Cost"]
+
+
+def to_cents(values):
+    """
+    Parse amounts into Int64 cents, rounded to the cent.
+    """
+    return (pd.to_numeric(pd.Series(values), errors="coerce") * 100).round().astype("Int64")
+
+
+def from_cents(cents):
+    """
+    Render Int64 cents as float amounts (missing values become NaN).
+    """
+    return cents.astype("float64") / 100
+
+
+def total(cents):
+    """
+    Sum of a cents column, as an amount.
+    """
+    return int(cents.sum()) / 100
+
+
+def working_report_path():
+    """
+    Detail rows live in detail_csv once the report has been consolidated.
+    """
+    return detail_csv if os.path.exists(detail_csv) else report_csv
+
+
+def load_report(path=None):
+    """
+    Load the working report with Account and SAP_ID as int64 keys.
+    """
+    with metrics.stage("load_report"):
+        report = pd.read_csv(path or working_report_path(), dtype={"Account": str, "Account Number": str})
+    report["Account"] = to_key(report["Account"])
+    report["SAP_ID"] = to_key(report["SAP_ID"], 0)
+    for column in MONEY_COLUMNS:
+        report[column] = to_cents(report[column])
+    return report
+
+
+def save_report(report, path=None):
+    """
+    Write the working report, formatting account keys back to padded strings
+    and cents back to amounts.
+    """
+    with metrics.stage("save_report"):
+        if pd.api.types.is_integer_dtype(report["Account"]):
+            report = report.assign(Account=format_account(report["Account"]))
+        money = [column for column in MONEY_COLUMNS if pd.api.types.is_integer_dtype(report[column])]
+        if money:
+            report = report.assign(**{column: from_cents(report[column]) for column in money})
+        report.to_csv(path or working_report_path(), index=False)
 
 # -----------------------
 # Azure Key Vault Setup
 # -----------------------
 VAULT_URL = "https://tds-bi-vault.vault.azure.net/"
 credential = DefaultAzureCredential()
-secret_client = SecretClient(vault_url=VAULT_URL, credential=credential)
+secret_client = SecretClient(vault_url=VAULT_URL, credential=credential, **resilience.client_options("keyvault"))
 
 # -----------------------
 # Country Configuration
@@ -64,22 +173,46 @@ emea_cfg = {
     "EMEA": {"secret_id": "api-keys-EMEA", "AWS": 57273, "Account_ID": 240},
 }
 
+# ion API base URL (ION_URL points it at a local stand-in for load tests)
+ION_URL = urllib.parse.urlsplit(os.environ.get("ION_URL", "https://ion.tdsynnex.com"))
+
+
+def ion_connection():
+    if ION_URL.scheme == "http":
+        return http.client.HTTPConnection(ION_URL.netloc, timeout=resilience.timeout("ion"))
+    return http.client.HTTPSConnection(ION_URL.netloc, timeout=resilience.timeout("ion"))
+
+
+def ion_request(method, path, body, headers):
+    """
+    Send one request to ion; returns the HTTP status and the decoded body.
+    """
+    conn = ion_connection()
+    try:
+        conn.request(method, path, body, headers)
+        res = conn.getresponse()
+        return res.status, res.read().decode("utf-8")
+    finally:
+        conn.close()
+
 # -----------------------
 # Helper: Refresh token
 # -----------------------
-def refresh_token(cfg):
+def get_token_secret(cfg):
+    secret_value = resilience.call("keyvault", "get_secret", secret_client.get_secret, cfg["secret_id"]).value
+    return json.loads(secret_value)
+
+
+def refresh_token(cfg, secret_json=None):
     """
     Refresh token and update Azure Key Vault.
     Works locally using kvault_connections().
     """
-    
-
-    conn = http.client.HTTPSConnection("ion.tdsynnex.com")
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
     # Get old secret
-    secret_value = secret_client.get_secret(cfg["secret_id"]).value
-    secret_json = json.loads(secret_value)
+    if secret_json is None:
+        secret_json = get_token_secret(cfg)
     old_refresh = secret_json["refresh_key"]
 
     # Call API for new token
@@ -87,21 +220,38 @@ def refresh_token(cfg):
         "grant_type": "refresh_token",
         "refresh_token": old_refresh
     })
-    conn.request("POST", "/oauth/token", body, headers)
-    resp = conn.getresponse()
-    resp_json = json.loads(resp.read().decode("utf-8"))
+    # not retried: the refresh key is single use
+    status, data = resilience.call("ion", "oauth_token", ion_request, "POST", "/oauth/token", body, headers,
+                                   retries=0)
+    resp_json = json.loads(data)
 
     new_refresh = resp_json["refresh_token"]
     new_access = resp_json["access_token"]
 
     # Update secret in Key Vault
-    secret_client.set_secret(
+    resilience.call(
+        "keyvault", "set_secret", secret_client.set_secret,
         cfg["secret_id"],
-        json.dumps({"refresh_key": new_refresh, "access_key": new_access})
+        json.dumps({"refresh_key": new_refresh, "access_key": new_access, "refreshed_at": int(time.time())})
     )
 
     return new_access
 
+
+def access_token(cfg):
+    """
+    The access token stored in Key Vault while it is fresh (the prefetch
+    job keeps it so), else a newly refreshed one.
+    """
+    secret_json = get_token_secret(cfg)
+    return prefetch.fresh_access_key(secret_json) or refresh_token(cfg, secret_json)
+
+
+class TokenRejected(RuntimeError):
+    """
+    ion answered 401 to a stored access token.
+    """
+
 # -----------------------
 # Get database password
 # -----------------------
@@ -109,137 +259,289 @@ def get_db_password():
     """
     Fetch database password from Azure Key Vault.
     """
-    secret_value = secret_client.get_secret("database-password").value
-    return secret_value
+    return resilience.call("keyvault", "get_secret", secret_client.get_secret, "database-password").value
 
 # Example usage
 db_password = get_db_password()
 
 # -----------------------
-# Main Function
+# SQL connection
 # -----------------------
-def run_awstool(country: str, start_date: str, end_date: str):
-    global  last_country, last_start_date, last_end_date
+def db_connect():
     """
-    Run AWS Tool:
-    1. Fetch country-level report (date range from HTML).
-    2. Fetch rolling 1-year EMEA report.
-    3. Merge/group both datasets into Billing_report.
+    Open a connection to the BI database holding aws.end_customer. SQL_TIMEOUT
+    bounds the login and each query.
     """
-    try:
-        # --- Step 1: Country-specific report ---
-        if country not in country_cfg:
-            return {"error": f"Country {country} not supported."}
-
-        cfg_country = country_cfg[country]
-        access_token_country = refresh_token(cfg_country)
-        
+    server = 'bicompute-dwh.database.windows.net'
+    database = 'db-cloudbi'
+    username = 'tdadmin'
+    driver = '{ODBC Driver 18 for SQL Server}'
+    password = db_password
+
+    conn = resilience.call(
+        "sql", "connect", pyodbc.connect,
+        f'DRIVER={driver};SERVER={server};DATABASE={database};UID={username};PWD={password}',
+        timeout=int(resilience.timeout("sql")),
+        retry_on=(pyodbc.OperationalError,)
+    )
+    conn.timeout = int(resilience.timeout("sql"))
+    return conn
 
-        # Dates → ISO8601
-        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-        end_dt   = datetime.strptime(end_date, "%Y-%m-%d")
-        start_iso = start_dt.strftime('%Y-%m-%dT00:00:00Z')
-        end_iso   = end_dt.strftime('%Y-%m-%dT23:59:59Z')
-
-        # Request payload
-        payload_country = {
-            "report_id": cfg_country["AWS"],
-            "report_module": "REPORTS_REPORTS_MODULE",
-            "category": "BILLING_REPORTS",
-            "specs": {
-                "date_range_option": {
-                    "selected_range": {
-                        "fixed_date_range": {"start_date": start_iso, "end_date": end_iso}
-                    }
+# -----------------------
+# Helper: Download report
+# -----------------------
+def report_request(cfg, start_iso, end_iso):
+    """
+    Path and JSON payload of a reportDataCsv request.
+    """
+    payload = {
+        "report_id": cfg["AWS"],
+        "report_module": "REPORTS_REPORTS_MODULE",
+        "category": "BILLING_REPORTS",
+        "specs": {
+            "date_range_option": {
+                "selected_range": {
+                    "fixed_date_range": {"start_date": start_iso, "end_date": end_iso}
                 }
             }
         }
+    }
+    return f"/api/v3/accounts/{cfg['Account_ID']}/reports/{cfg['AWS']}/reportDataCsv", payload
 
-        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {access_token_country}"}
-        conn = http.client.HTTPSConnection("ion.tdsynnex.com")
-        conn.request(
-            "POST",
-            f"/api/v3/accounts/{cfg_country['Account_ID']}/reports/{cfg_country['AWS']}/reportDataCsv",
-            json.dumps(payload_country),
-            headers
-        )
-        res = conn.getresponse()
-        data = res.read().decode("utf-8")
 
-        if res.status != 200:
-            return {"error": f"Country {country} failed: HTTP {res.status} - {data}"}
+def fetch_report_csv(cfg, access_token, start_iso, end_iso):
+    """
+    Request one reportDataCsv export from ion, retrying connection errors,
+    429 and 5xx (FETCH_RETRIES times, FETCH_RETRY_BACKOFF seconds apart,
+    doubling). Returns the HTTP status and the response body.
+    """
+    path, payload = report_request(cfg, start_iso, end_iso)
 
-        report_json = json.loads(data)
-        df_country = pd.read_csv(io.StringIO(report_json["results"]))
-
-        # Normalize country df
-        df_country.columns = df_country.columns.str.replace('SAP_ID', 'SAP ID')
-        df_country['Country'] = country
-
-        # Standardize cost/margin columns
-        df_country.columns = df_country.columns.str.replace(
-            r'Seller Cost \((EUR|GBP|NOK|SEK|CHF|DKK|USD|AUD|CAD|HKD|INR)\)', 'Seller Cost', regex=True)
-        df_country.columns = df_country.columns.str.replace(
-            r'Customer Cost \((EUR|GBP|NOK|SEK|CHF|DKK|USD|AUD|CAD|HKD|INR)\)', 'Customer Cost', regex=True)
-        df_country.columns = df_country.columns.str.replace(
-            r'Margin \((EUR|GBP|NOK|SEK|CHF|DKK|USD|AUD|CAD|HKD|INR)\)', 'Margin', regex=True)
-        df_country.columns = df_country.columns.str.replace(
-            r'Sales Price Of Unit \((EUR|GBP|NOK|SEK|CHF|DKK|USD|AUD|CAD|HKD|INR)\)', 'Sales Price Of Unit', regex=True)
-
-        # --- Step 2: EMEA rolling report ---
-
-        cfg_emea = emea_cfg["EMEA"]
-        access_token_emea = refresh_token(cfg_emea)
-
-        end_dt = datetime.utcnow()
-        start_dt = end_dt - timedelta(days=365)
-        start_iso = start_dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-        end_iso   = end_dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-        payload_emea = {
-            "report_id": cfg_emea["AWS"],
-            "report_module": "REPORTS_REPORTS_MODULE",
-            "category": "BILLING_REPORTS",
-            "specs": {
-                "date_range_option": {
-                    "selected_range": {
-                        "fixed_date_range": {"start_date": start_iso, "end_date": end_iso}
-                    }
-                }
-            }
-        }
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {access_token}"}
+
+    def download():
+        status, data = ion_request("POST", path, json.dumps(payload), headers)
+        if resilience.retryable_status(status):
+            raise resilience.TransientStatus(status, data)
+        return status, data
 
-        headers_emea = {"Content-Type": "application/json", "Authorization": f"Bearer {access_token_emea}"}
-        conn.request(
-            "POST",
-            f"/api/v3/accounts/{cfg_emea['Account_ID']}/reports/{cfg_emea['AWS']}/reportDataCsv",
-            json.dumps(payload_emea),
-            headers_emea
+    try:
+        status, data = resilience.call("ion", "report_download", download,
+                                       retries=FETCH_RETRIES, backoff=FETCH_RETRY_BACKOFF)
+    except resilience.TransientStatus as e:
+        status, data = e.status, e.body
+
+    metrics.payload("ion_report", len(data))
+    return status, data
+
+
+def fetch_reports(reports):
+    """
+    Get a token and download the report for each (cfg, start_iso,
+    end_iso). With ASYNC_IO=1 they are all in flight at once (see aio),
+    otherwise they run one after the other.
+    """
+    if aio.enabled() and reports:
+        return aio.fetch_reports(
+            f"{ION_URL.scheme}://{ION_URL.netloc}",
+            VAULT_URL,
+            [(cfg["secret_id"],) + report_request(cfg, start_iso, end_iso) for cfg, start_iso, end_iso in reports]
         )
-        res = conn.getresponse()
-        data = res.read().decode("utf-8")
 
-        if res.status != 200:
-            return {"error": f"EMEA failed: HTTP {res.status} - {data}"}
+    results = []
+    for cfg, start_iso, end_iso in reports:
+        status, data = fetch_report_csv(cfg, access_token(cfg), start_iso, end_iso)
+        if status == 401:
+            # the stored token was revoked or expired early
+            status, data = fetch_report_csv(cfg, refresh_token(cfg), start_iso, end_iso)
+        results.append((status, data))
+    return results
+
+
+# -----------------------
+# Long ranges: fetch the country report per window
+# -----------------------
+# Ranges longer than FETCH_SPLIT_DAYS are requested as windows of
+# FETCH_WINDOW_MONTHS calendar months, FETCH_PARALLELISM at a time, each
+# retried on its own by fetch_report_csv.
+FETCH_SPLIT_DAYS = int(os.environ.get("FETCH_SPLIT_DAYS", 45))
+FETCH_WINDOW_MONTHS = int(os.environ.get("FETCH_WINDOW_MONTHS", 1))
+FETCH_PARALLELISM = int(os.environ.get("FETCH_PARALLELISM", 4))
+FETCH_RETRIES = int(os.environ.get("FETCH_RETRIES", 2))
+FETCH_RETRY_BACKOFF = float(os.environ.get("FETCH_RETRY_BACKOFF", 2))
+
+
+def parse_period(start_date, end_date):
+    """
+    Parse the YYYY-MM-DD start and end dates of a run; raises InputError
+    when one is invalid or the end comes before the start.
+    """
+    try:
+        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise InputError("start_date and end_date must be dates as YYYY-MM-DD")
+    if end_dt < start_dt:
+        raise InputError("end_date is before start_date")
+    return start_dt, end_dt
+
+
+def date_windows(start_dt, end_dt):
+    """
+    Split the whole days [start_dt, end_dt] into calendar-month windows;
+    short ranges stay one window.
+    """
+    if FETCH_WINDOW_MONTHS <= 0 or (end_dt - start_dt).days + 1 <= FETCH_SPLIT_DAYS:
+        return [(start_dt, end_dt)]
+
+    windows = []
+    window_start = start_dt
+    while window_start <= end_dt:
+        month = window_start.year * 12 + window_start.month - 1 + FETCH_WINDOW_MONTHS
+        next_start = datetime(month // 12, month % 12 + 1, 1)
+        windows.append((window_start, min(next_start - timedelta(days=1), end_dt)))
+        window_start = next_start
+    return windows
+
+
+def fetch_window(country, cfg, access_token, window):
+    """
+    Fetch and parse the country report for one window.
+    """
+    window_start, window_end = window
+    start_iso = window_start.strftime('%Y-%m-%dT00:00:00Z')
+    end_iso   = window_end.strftime('%Y-%m-%dT23:59:59Z')
+
+    try:
+        status, data = fetch_report_csv(cfg, access_token, start_iso, end_iso)
+        if status == 200:
+            return read_report_results(data)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        status, data = None, str(e)
+
+    if status == 401:
+        raise TokenRejected(f"Country {country}: access token rejected")
+
+    raise RuntimeError(
+        f"Country {country} failed for {window_start:%Y-%m-%d} to {window_end:%Y-%m-%d}: HTTP {status} - {data}")
+
+
+def fetch_country_windows(country, cfg, windows):
+    """
+    Fetch the country report window by window and concatenate the parts.
+    One token serves every window: refreshing rotates the refresh key.
+    """
+    def fetch_all(token):
+        with ThreadPoolExecutor(max_workers=FETCH_PARALLELISM) as pool:
+            return list(pool.map(lambda window: fetch_window(country, cfg, token, window), windows))
+
+    try:
+        frames = fetch_all(access_token(cfg))
+    except TokenRejected:
+        # the stored token was revoked or expired early
+        frames = fetch_all(refresh_token(cfg))
+    return pd.concat(frames, ignore_index=True)
+
 
+def read_report_results(data):
+    """
+    Parse the CSV embedded in a reportDataCsv response.
+    """
+    with metrics.stage("parse_csv"):
         report_json = json.loads(data)
-        final_df = pd.read_csv(io.StringIO(report_json["results"]))
+        return pd.read_csv(io.StringIO(report_json["results"]))
+
+def emea_range():
+    """
+    The rolling year of the EMEA report, as (start_iso, end_iso).
+    """
+    emea_end_dt = datetime.utcnow()
+    emea_start_dt = emea_end_dt - timedelta(days=365)
+    return emea_start_dt.strftime('%Y-%m-%dT%H:%M:%SZ'), emea_end_dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def emea_mapping(final_df):
+    """
+    The EMEA rows merged into country reports: accounts with an assigned
+    customer company, keyed like Cloud Account Number.
+    """
+    if final_df is None:
+        return None
+
+    final_df = final_df[final_df["Assigned Customer Company"].notna() & (final_df["Assigned Customer Company"] != "")]
+
+    final_df['Account Number'] = to_key(final_df['Account Number'])
+    return final_df[final_df['Account Number'] != MISSING_KEY]
+
 
-        df_country['SAP ID (customer)'] = pd.to_numeric(df_country['SAP ID (customer)'], errors="coerce")  # convert invalid to NaN
-        df_country['SAP ID (customer)'] = df_country['SAP ID (customer)'].fillna(999999).astype(int)
+# -----------------------
+# Main Function
+# -----------------------
+def fetch_billing_report(country: str, start_date: str, end_date: str):
+    """
+    Fetch the country report and the rolling EMEA report from ion and merge
+    them into one Billing_report frame (nothing is written to disk).
+    """
+    if country not in country_cfg:
+        raise InputError(f"Country {country} not supported.")
+
+    cfg_country = country_cfg[country]
+    cfg_emea = emea_cfg["EMEA"]
+
+    # Dates → ISO8601
+    start_dt, end_dt = parse_period(start_date, end_date)
+    start_iso = start_dt.strftime('%Y-%m-%dT00:00:00Z')
+    end_iso   = end_dt.strftime('%Y-%m-%dT23:59:59Z')
+
+    # EMEA mapping: prefetched, or fetched with the country report
+    final_df = prefetch.load("emea", PREFETCH_EMEA_MAX_AGE)
+    emea_request = [] if final_df is not None else [(cfg_emea,) + emea_range()]
+
+    windows = date_windows(start_dt, end_dt)
+    if len(windows) == 1:
+        results = fetch_reports([(cfg_country, start_iso, end_iso)] + emea_request)
+        status, data = results[0]
+
+        if status != 200:
+            raise RuntimeError(f"Country {country} failed: HTTP {status} - {data}")
+
+        df_country = read_report_results(data)
+        emea_results = results[1:]
+    else:
+        # the EMEA report downloads while the country windows are fetched
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            emea = pool.submit(fetch_reports, emea_request)
+            df_country = fetch_country_windows(country, cfg_country, windows)
+            emea_results = emea.result()
+
+    # Normalize country df
+    df_country.columns = df_country.columns.str.replace('SAP_ID', 'SAP ID')
+    df_country['Country'] = country
+
+    # Standardize cost/margin columns
+    df_country.columns = df_country.columns.str.replace(
+        r'Seller Cost \((EUR|GBP|NOK|SEK|CHF|DKK|USD|AUD|CAD|HKD|INR)\)', 'Seller Cost', regex=True)
+    df_country.columns = df_country.columns.str.replace(
+        r'Customer Cost \((EUR|GBP|NOK|SEK|CHF|DKK|USD|AUD|CAD|HKD|INR)\)', 'Customer Cost', regex=True)
+    df_country.columns = df_country.columns.str.replace(
+        r'Margin \((EUR|GBP|NOK|SEK|CHF|DKK|USD|AUD|CAD|HKD|INR)\)', 'Margin', regex=True)
+    df_country.columns = df_country.columns.str.replace(
+        r'Sales Price Of Unit \((EUR|GBP|NOK|SEK|CHF|DKK|USD|AUD|CAD|HKD|INR)\)', 'Sales Price Of Unit', regex=True)
 
+    # --- Step 2: EMEA rolling report ---
 
-        df_country['SAP ID (customer)'] = df_country['SAP ID (customer)'].astype('Int32')
-        df_country['Cloud Account Number'] = df_country['Cloud Account Number'].astype(str).str.zfill(12)
+    for emea_status, emea_data in emea_results:
+        if emea_status != 200:
+            raise RuntimeError(f"EMEA failed: HTTP {emea_status} - {emea_data}")
 
+        final_df = emea_mapping(read_report_results(emea_data))
 
-        if final_df is not None:
+    df_country['SAP ID (customer)'] = to_key(df_country['SAP ID (customer)'], UNKNOWN_SAP_ID)
+    df_country['Cloud Account Number'] = to_key(df_country['Cloud Account Number'])
 
-            final_df = final_df[final_df["Assigned Customer Company"].notna() & (final_df["Assigned Customer Company"] != "")]
-            
-            final_df['Account Number'] = final_df['Account Number'].astype(str)
-            
-            global Billing_report, last_country, last_start_date, last_end_date
+    if final_df is not None:
+
+        with metrics.stage("merge"):
             Billing_report = pd.merge(
                 df_country,
                 final_df,
@@ -247,38 +549,46 @@ def run_awstool(country: str, start_date: str, end_date: str):
                 right_on=['Account Number'],
                 how="left"
             )
-        else:
-            Billing_report = df_country.copy()
+        # kept as text, like the other columns of the downloaded report
+        account_number = Billing_report['Account Number']
+        Billing_report['Account Number'] = account_number.astype("Int64").astype(str).where(account_number.notna())
+    else:
+        Billing_report = df_country.copy()
+
+    # Rename for clarity
+    rename_mapping = {
+        "Cloud Account Number": "Account",
+        "SAP ID (customer)": "SAP_ID",
+        "Product Name": "Materials",
+        "Assigned Customer Company": "End_Customer",
+    }
+    Billing_report.rename(columns=rename_mapping, inplace=True)
 
+    for column in MONEY_COLUMNS:
+        Billing_report[column] = to_cents(Billing_report[column])
 
-            
+    metrics.rows("fetch", len(Billing_report))
+    return Billing_report
 
 
+def run_awstool(country: str, start_date: str, end_date: str):
+    global  last_country, last_start_date, last_end_date
+    """
+    Run AWS Tool:
+    1. Fetch country-level report (date range from HTML).
+    2. Fetch rolling 1-year EMEA report.
+    3. Merge/group both datasets into Billing_report.
+    """
+    try:
+        Billing_report = fetch_billing_report(country, start_date, end_date)
+
         last_country = country
         last_start_date = start_date
         last_end_date = end_date    
 
-        # Rename for clarity
-        rename_mapping = {
-            "Cloud Account Number": "Account",
-            "SAP ID (customer)": "SAP_ID",
-            "Product Name": "Materials",
-            "Assigned Customer Company": "End_Customer",
-        }
-        Billing_report.rename(columns=rename_mapping, inplace=True)
-
-        Billing_report['Account'] = Billing_report['Account'].astype(str).str.zfill(12)
-
-        #Billing_report['Account'] = pd.to_numeric(Billing_report['Account'], errors='coerce').astype('Int64')
-
-        Billing_report["Seller Cost"] = pd.to_numeric(Billing_report["Seller Cost"], errors='coerce').round(2)
-        Billing_report["Customer Cost"] = pd.to_numeric(Billing_report["Customer Cost"], errors='coerce').round(2)
-
-        Billing_report["SAP_ID"] = pd.to_numeric(Billing_report["SAP_ID"], errors="coerce")  # convert invalid to NaN
-        Billing_report["SAP_ID"] = Billing_report["SAP_ID"].fillna(999999).astype(int)
-
-
-        Billing_report.to_csv("latest_report.csv", index=False)
+        # a new report starts a new consolidation
+        reset_consolidation(keep_detail=False)
+        save_report(Billing_report)
 
         # save metadata in parallel
         metadata = {
@@ -290,24 +600,240 @@ def run_awstool(country: str, start_date: str, end_date: str):
         with open("metadata.json", "w") as f:
             json.dump(metadata, f)
 
-        # Calculate sums
-        seller_sum = Billing_report["Seller Cost"].sum()
-        customer_sum = Billing_report["Customer Cost"].sum()
-
         return {
             "final_df_message": f"from {start_date} to {end_date}",
             "country": country,
-            "seller_sum": Billing_report["Seller Cost"].sum(),
-            "customer_sum": Billing_report["Customer Cost"].sum()
+            "seller_sum": total(Billing_report["Seller Cost"]),
+            "customer_sum": total(Billing_report["Customer Cost"])
         }
 
+    except Exception as e:
+        return {"error": str(e)}
 
 
+# -----------------------------
+# Adjustment files
+# -----------------------------
+EXCEPTION_HEADERS = ["SAP ID", "Account"]
+CREDIT_HEADERS = ["Account", "Credit"]
+PO_HEADERS = ["Reseller SAP ID", "End Customer", "PO", "PO Condition"]
+
+# CSV adjustment files are parsed this many rows at a time
+ADJUSTMENT_CHUNK_ROWS = int(os.environ.get("ADJUSTMENT_CHUNK_ROWS", 100000))
 
-    
 
+def read_adjustment_file(uploaded_file, expected_headers, compact=None, **read_csv_kwargs):
+    """
+    Read an uploaded CSV / XLSX adjustment file and check its header.
+    CSV files are read in chunks and each chunk is reduced with `compact`
+    (one of the compact_* functions), so a large file never sits in memory
+    as strings all at once.
+    """
+    check_headers(sniff_columns(uploaded_file, read_csv_kwargs.get("encoding", "utf-8")), expected_headers)
+
+    # Load file (CSV or XLSX)
+    if uploaded_file.filename.endswith(".csv"):
+        chunks = []
+        with pd.read_csv(uploaded_file, chunksize=ADJUSTMENT_CHUNK_ROWS, **read_csv_kwargs) as reader:
+            for chunk in reader:
+                check_headers(chunk, expected_headers)
+                chunks.append(compact(chunk) if compact else chunk)
+        df = pd.concat(chunks, ignore_index=True)
+    elif uploaded_file.filename.endswith(".xlsx"):
+        df = pd.read_excel(uploaded_file)
+    else:
+        raise InputError("Unsupported file type. Please upload credit with proper format.")
+
+    check_headers(df, expected_headers)
+    return compact(df) if compact else df
+
+
+def sniff_columns(uploaded_file, encoding="utf-8"):
+    """
+    Column names of an uploaded CSV / XLSX file, read from its header row
+    only (the first row of the first sheet for XLSX). The stream is
+    rewound afterwards so the file can then be parsed in full.
+    """
+    if not uploaded_file.filename.endswith((".csv", ".xlsx")):
+        raise InputError("Unsupported file type. Please upload credit with proper format.")
+
+    stream = uploaded_file.stream
+    try:
+        if uploaded_file.filename.endswith(".csv"):
+            # utf-8-sig drops a byte order mark, as pandas does
+            line = stream.readline().decode("utf-8-sig" if encoding.lower() in ("utf-8", "utf8") else encoding)
+            return next(csv.reader([line]), [])
+
+        wb = load_workbook(stream, read_only=True)
+        try:
+            header = list(next(wb.worksheets[0].iter_rows(max_row=1, values_only=True), ()))
+        finally:
+            wb.close()
+        while header and header[-1] is None:
+            header.pop()
+        return ["" if value is None else str(value) for value in header]
     except Exception as e:
-        return {"error": str(e)}
+        raise InputError(f"Could not read the file header: {e}")
+    finally:
+        stream.seek(0)
+
+
+def check_headers(df_or_columns, expected_headers):
+    columns = df_or_columns.columns if isinstance(df_or_columns, pd.DataFrame) else df_or_columns
+    if list(columns) != expected_headers:
+        raise InputError(f"Header is not correct. Expected: {', '.join(expected_headers)}")
+
+
+# The compact_* functions parse the keys of an adjustment file and drop the
+# rows that cannot have an effect. They are idempotent, so they can run per
+# chunk and again on the concatenated chunks.
+
+def compact_exceptions(exceptions):
+    exceptions = exceptions.copy()
+    exceptions['Account'] = to_key(exceptions['Account'])
+
+    exceptions['SAP ID'] = to_key(exceptions['SAP ID'])
+
+    exceptions = exceptions[exceptions['SAP ID'] != MISSING_KEY]
+
+    # last one wins
+    return exceptions.drop_duplicates("Account", keep="last")
+
+
+def compact_credits(credit_df):
+    credit_df = credit_df.copy()
+    credit_df['Account'] = to_key(credit_df['Account'])
+    return credit_df
+
+
+def compact_po(custom_po_df):
+    custom_po_df = custom_po_df.copy()
+    custom_po_df['End Customer'] = to_key(custom_po_df['End Customer'])
+
+    custom_po_df['Reseller SAP ID'] = to_key(custom_po_df['Reseller SAP ID'])
+
+    custom_po_df = custom_po_df[
+        (custom_po_df['End Customer'] != MISSING_KEY) & (custom_po_df['Reseller SAP ID'] != MISSING_KEY)
+    ]
+    return custom_po_df.drop_duplicates()
+
+
+def exception_adjust(Billing_report, exceptions):
+    """
+    Move accounts to the SAP ID given in the exceptions (last one wins).
+    Returns the report and the old and new SAP IDs of the rows that moved.
+    """
+    exceptions = compact_exceptions(exceptions)
+
+    # Create a mapping from Account → SAP ID from exceptions (last one wins)
+
+    account_to_sap = exceptions.set_index("Account")["SAP ID"]
+    
+    # Update SAP_ID in Billing_report wherever Account matches
+
+    old_sap_id = Billing_report["SAP_ID"]
+    with metrics.stage("apply_exception"):
+        Billing_report["SAP_ID"] = (
+            Billing_report["Account"].map(account_to_sap)
+            .fillna(Billing_report["SAP_ID"])
+            .astype("int64")
+        )
+
+    changed = Billing_report["SAP_ID"] != old_sap_id
+    return Billing_report, pd.concat([old_sap_id[changed], Billing_report.loc[changed, "SAP_ID"]])
+
+
+def allocate_credit(costs, accounts, credit):
+    """
+    Deduct each account's credit from its costs in row order until the credit
+    is used up: the deduction of a row is what is left of the credit after the
+    account's earlier rows, capped at the row's cost. costs are cents and
+    credit maps accounts to cents; returns the new costs.
+
+    Accounts with missing or negative costs go through the row by row loop,
+    where a negative cost row is zeroed and gives its amount back to the
+    credit, and a missing cost stops the deduction.
+    """
+    costs = costs.copy()
+    rows = accounts.isin(credit.index)
+    irregular = accounts[rows & (costs.isna() | (costs < 0))].unique()
+    regular = rows & ~accounts.isin(irregular)
+
+    if regular.any():
+        row_costs = costs[regular].to_numpy("int64")
+        row_accounts = accounts[regular]
+        # costs of the account's earlier rows
+        before = pd.Series(row_costs).groupby(row_accounts.to_numpy()).cumsum().to_numpy() - row_costs
+        left = row_accounts.map(credit).to_numpy("int64") - before
+        costs[regular] = row_costs - np.minimum(np.maximum(left, 0), row_costs)
+
+    for account in irregular:
+        left = credit[account]
+        for idx in accounts.index[accounts == account]:
+            if left <= 0:
+                break
+            if pd.isna(costs.at[idx]):
+                break
+            deduction = min(costs.at[idx], left)
+            costs.at[idx] -= deduction
+            left -= deduction
+
+    return costs
+
+
+def credit_adjust(Billing_report, credit_df):
+    """
+    Deduct each account's credit from its rows' costs, row by row until the
+    credit is used up. Returns the report and the SAP IDs of changed rows.
+    """
+    credit_df = compact_credits(credit_df)
+
+    # non-positive credits have no effect; several credits for an account add up
+    credit_df = credit_df.assign(Credit=to_cents(credit_df['Credit']))
+    credit = credit_df[credit_df['Credit'] > 0].groupby('Account')['Credit'].sum().astype("int64")
+
+    old_costs = Billing_report[MONEY_COLUMNS].copy()
+
+    # Apply credits to Billing_report, separately to Seller and Customer Cost
+    with metrics.stage("apply_credits"):
+        for column in MONEY_COLUMNS:
+            Billing_report[column] = allocate_credit(Billing_report[column], Billing_report['Account'], credit)
+
+    changed = (Billing_report[MONEY_COLUMNS] != old_costs).any(axis=1)
+    return Billing_report, Billing_report.loc[changed, 'SAP_ID']
+
+
+def po_adjust(Billing_report, custom_po_df):
+    """
+    Set the PO of the rows matching a (Reseller SAP ID, End Customer) pair;
+    a later PO file only overrides the rows it matches. Returns the report
+    and the SAP IDs of the matched rows.
+    """
+    custom_po_df = compact_po(custom_po_df)
+
+    custom_po_df_unique = custom_po_df[['Reseller SAP ID', 'End Customer','PO','PO Condition'
+                    ]].drop_duplicates().rename(columns={'PO': 'PO_new'})
+
+    with metrics.stage("apply_po"):
+        Billing_report = pd.merge(Billing_report, 
+                             custom_po_df_unique,  
+                             left_on=['SAP_ID','Account'
+                                      ],  # Columns in `sc_df`
+                            right_on=['Reseller SAP ID', 'End Customer'
+                                      ],        # Columns in `cee_df`
+                                      how="left"  # Perform a left join
+                                      )
+
+    matched = Billing_report['PO_new'].notna()
+    if 'PO' in Billing_report.columns:
+        Billing_report['PO'] = Billing_report['PO_new'].combine_first(Billing_report['PO'])
+    else:
+        Billing_report['PO'] = Billing_report['PO_new']
+
+    Billing_report = Billing_report.drop(['Reseller SAP ID',
+                                    'End Customer', 'PO Condition', 'PO_new'], axis=1)
+
+    return Billing_report, Billing_report.loc[matched, 'SAP_ID']
 
 
 # -----------------------------
@@ -319,8 +845,6 @@ def run_awstool(country: str, start_date: str, end_date: str):
 def apply_exception(uploaded_file):
     global  last_country, last_start_date, last_end_date
 
-    expected_headers = ["SAP ID", "Account"]  
-
     try:
 
         # Reload metadata
@@ -333,53 +857,24 @@ def apply_exception(uploaded_file):
 
 
 
-        Billing_report = pd.read_csv("latest_report.csv", dtype={"Account": str})
-        Billing_report["Account"] = Billing_report["Account"].str.zfill(12)
-        # If SAP_ID must also be integer:
-        Billing_report["SAP_ID"] = Billing_report["SAP_ID"].astype("Int64")
-        # Load file (CSV or XLSX)
-        if uploaded_file.filename.endswith(".csv"):
-            exceptions = pd.read_csv(uploaded_file)
-        elif uploaded_file.filename.endswith(".xlsx"):
-            exceptions = pd.read_excel(uploaded_file)
-        else:
-            return {"error": "Unsupported file type. Please upload credit with proper format."}
-
-        # Validate headers
-        if list(exceptions.columns) != expected_headers:
-            return {"error": f"Header is not correct. Expected: {', '.join(expected_headers)}"}
-        
-
-        exceptions['Account'] = exceptions['Account'].astype(str).str.zfill(12)
-
-        exceptions['SAP ID'] = exceptions['SAP ID'].astype('Int64')
-
-        # Create a mapping from Account → SAP ID from exceptions
-
-        account_to_sap = exceptions.set_index("Account")["SAP ID"].to_dict()
-        
-        # Update SAP_ID in Billing_report wherever Account matches
-
-        Billing_report["SAP_ID"] = Billing_report["Account"].map(account_to_sap).combine_first(Billing_report["SAP_ID"])
+        # the upload is checked and parsed before the report is loaded
+        exceptions = read_adjustment_file(uploaded_file, EXCEPTION_HEADERS, compact_exceptions)
+        Billing_report = load_report()
 
+        Billing_report, touched = exception_adjust(Billing_report, exceptions)
+        mark_dirty(touched)
 
-        Billing_report.to_csv("latest_report.csv", index=False)
-
-        # Update summary after adjustments
-        seller_sum = Billing_report["Seller Cost"].sum()
-        customer_sum = Billing_report["Customer Cost"].sum()
+        save_report(Billing_report)
 
         return {
             "final_df_message": f"from {start_date} to {end_date} (Exception Applied)",
             "country": country,
-            "seller_sum": Billing_report["Seller Cost"].sum(),
-            "customer_sum": Billing_report["Customer Cost"].sum()
+            "seller_sum": total(Billing_report["Seller Cost"]),
+            "customer_sum": total(Billing_report["Customer Cost"])
         }
 
-
-    
-
-
+    except InputError as e:
+        return {"error": str(e)}
 
     except Exception as e:
         print(traceback.format_exc())
@@ -397,9 +892,6 @@ def apply_exception(uploaded_file):
 def apply_credit_adjustments(uploaded_file):
     global  last_country, last_start_date, last_end_date
 
-    expected_headers = ["Account", "Credit"]
-
-
     try:
 
         # Reload metadata
@@ -413,66 +905,24 @@ def apply_credit_adjustments(uploaded_file):
 
 
 
-        Billing_report = pd.read_csv("latest_report.csv", dtype={"Account": str})
-        Billing_report["Account"] = Billing_report["Account"].str.zfill(12)
-        # If SAP_ID must also be integer:
-        Billing_report["SAP_ID"] = Billing_report["SAP_ID"].astype("Int64")
-        # Load file (CSV or XLSX)
-        if uploaded_file.filename.endswith(".csv"):
-            credit_df = pd.read_csv(uploaded_file)
-        elif uploaded_file.filename.endswith(".xlsx"):
-            credit_df = pd.read_excel(uploaded_file)
-        else:
-            return {"error": "Unsupported file type. Please upload credit with proper format."}
-
-        # Validate headers
-        if list(credit_df.columns) != expected_headers:
-            return {"error": f"Header is not correct. Expected: {', '.join(expected_headers)}"}
-        
-
-        credit_df['Account'] = credit_df['Account'].astype(str).str.zfill(12)
-
-
-        # Apply credits to Billing_report
-        for _, credit_row in credit_df.iterrows():
-            account_id = credit_row['Account']
-            credit_amount_seller = credit_row['Credit']  # apply to Seller Cost
-            credit_amount_customer = credit_row['Credit']  # apply to Customer Cost
-
-            # Select rows in Billing_report for this account
-            account_rows = Billing_report.index[Billing_report['Account'] == account_id]
-
-            for idx in account_rows:
-                # Seller Cost adjustment
-                if credit_amount_seller > 0:
-                    deduction = min(Billing_report.at[idx, 'Seller Cost'], credit_amount_seller)
-                    Billing_report.at[idx, 'Seller Cost'] -= deduction
-                    credit_amount_seller -= deduction
+        # the upload is checked and parsed before the report is loaded
+        credit_df = read_adjustment_file(uploaded_file, CREDIT_HEADERS, compact_credits)
+        Billing_report = load_report()
 
-                # Customer Cost adjustment
-                if credit_amount_customer > 0:
-                    deduction = min(Billing_report.at[idx, 'Customer Cost'], credit_amount_customer)
-                    Billing_report.at[idx, 'Customer Cost'] -= deduction
-                    credit_amount_customer -= deduction
+        Billing_report, touched = credit_adjust(Billing_report, credit_df)
+        mark_dirty(touched)
 
-                # Stop early if both credits exhausted
-                if credit_amount_seller <= 0 and credit_amount_customer <= 0:
-                    break
-
-        Billing_report.to_csv("latest_report.csv", index=False)
-
-        # Update summary after adjustments
-        seller_sum = Billing_report["Seller Cost"].sum()
-        customer_sum = Billing_report["Customer Cost"].sum()
+        save_report(Billing_report)
 
         return {
             "final_df_message": f"from {start_date} to {end_date} (Adjusted with credit)",
             "country": country,
-            "seller_sum": Billing_report["Seller Cost"].sum(),
-            "customer_sum": Billing_report["Customer Cost"].sum()
+            "seller_sum": total(Billing_report["Seller Cost"]),
+            "customer_sum": total(Billing_report["Customer Cost"])
         }
 
-    
+    except InputError as e:
+        return {"error": str(e)}
 
     except Exception as e:
         print(traceback.format_exc())
@@ -488,9 +938,6 @@ def apply_credit_adjustments(uploaded_file):
 def apply_po_adjustments(uploaded_file):
     global  last_country, last_start_date, last_end_date
 
-    expected_headers = ["Reseller SAP ID", "End Customer", "PO", "PO Condition"]
-
-
     try:
 
         # Reload metadata
@@ -503,69 +950,24 @@ def apply_po_adjustments(uploaded_file):
 
 
 
-        Billing_report = pd.read_csv("latest_report.csv", dtype={"Account": str})
-        Billing_report["Account"] = Billing_report["Account"].str.zfill(12)
-        # If SAP_ID must also be integer:
-        Billing_report["SAP_ID"] = Billing_report["SAP_ID"].astype("Int64")
-        # Load file (CSV or XLSX)
-        if uploaded_file.filename.endswith(".csv"):
-            custom_po_df = pd.read_csv(uploaded_file, encoding="latin1")
-        elif uploaded_file.filename.endswith(".xlsx"):
-            custom_po_df = pd.read_excel(uploaded_file)
-        else:
-            return {"error": "Unsupported file type. Please upload credit with proper format."}
-
-        # Validate headers
-        if list(custom_po_df.columns) != expected_headers:
-            return {"error": f"Header is not correct. Expected: {', '.join(expected_headers)}"}
-        
-
-        custom_po_df['End Customer'] = pd.to_numeric(custom_po_df['End Customer'], errors='coerce')
-
-        custom_po_df['End Customer'] = custom_po_df['End Customer'].astype('Int64')
-
-        custom_po_df['End Customer'] = custom_po_df['End Customer'].astype(str).str.zfill(12)
-
-        custom_po_df['Reseller SAP ID'] = custom_po_df['Reseller SAP ID'].astype('Int64')
-
-
-
-    
-        
-
-        custom_po_df_unique = custom_po_df[['Reseller SAP ID', 'End Customer','PO','PO Condition'
-                        ]].drop_duplicates()
-
-        
-
-        Billing_report = pd.merge(Billing_report, 
-                             custom_po_df_unique,  
-                             left_on=['SAP_ID','Account'
-                                      ],  # Columns in `sc_df`
-                            right_on=['Reseller SAP ID', 'End Customer'
-                                      ],        # Columns in `cee_df`
-                                      how="left"  # Perform a left join
-                                      )
-        
+        # the upload is checked and parsed before the report is loaded
+        custom_po_df = read_adjustment_file(uploaded_file, PO_HEADERS, compact_po, encoding="latin1")
+        Billing_report = load_report()
 
-        Billing_report = Billing_report.drop(['Reseller SAP ID',
-                                        'End Customer', 'PO Condition'], axis=1)
+        Billing_report, touched = po_adjust(Billing_report, custom_po_df)
+        mark_dirty(touched)
         
-        Billing_report.to_csv("latest_report.csv", index=False)
-
-        # Update summary after adjustments
-        seller_sum = Billing_report["Seller Cost"].sum()
-        customer_sum = Billing_report["Customer Cost"].sum()
-
+        save_report(Billing_report)
 
         return {
             "final_df_message": f"from {start_date} to {end_date} (Adjusted with PO)",
             "country": country,
-            "seller_sum": Billing_report["Seller Cost"].sum(),
-            "customer_sum": Billing_report["Customer Cost"].sum()
+            "seller_sum": total(Billing_report["Seller Cost"]),
+            "customer_sum": total(Billing_report["Customer Cost"])
         }
 
-    
+    except InputError as e:
+        return {"error": str(e)}
 
     except Exception as e:
         print(traceback.format_exc())
@@ -582,18 +984,11 @@ def get_sap_ids():
     """
     try:
         # --- SQL connection ---
-        server = 'bicompute-dwh.database.windows.net'
-        database = 'db-cloudbi'
-        username = 'tdadmin'
-        driver = '{ODBC Driver 18 for SQL Server}'
-        password= db_password
-
-        conn = pyodbc.connect(
-            f'DRIVER={driver};SERVER={server};DATABASE={database};UID={username};PWD={password}'
-        )
+        conn = db_connect()
 
         query = "SELECT * FROM aws.end_customer"
-        sap_ids_df = pd.read_sql(query, conn)
+        with metrics.dependency("sql", "end_customer_query"):
+            sap_ids_df = pd.read_sql(query, conn)
         conn.close()
 
         # Format as consolidation DataFrame
@@ -611,195 +1006,370 @@ def get_sap_ids():
 # -----------------------------
     
 
-            # -----------------------------
+# -----------------------------
 # New: function to add final consolidation  
 # -----------------------------
 
-def consolidation():
-    global  last_country, last_start_date, last_end_date
+def get_end_customer_ids():
+    """
+    The SAP IDs consolidated by end customer: prefetched, or queried.
+    """
+    consolidation_unique = prefetch.load("end_customers", PREFETCH_END_CUSTOMERS_MAX_AGE)
+    if consolidation_unique is not None:
+        return consolidation_unique
+    return query_end_customer_ids()
 
-    try:
 
-        # Reload metadata
-        with open("metadata.json") as f:
-            metadata = json.load(f)
+def query_end_customer_ids():
+    """
+    Query the SAP IDs consolidated by end customer (aws.end_customer).
+    """
+    conn = db_connect()
 
-        country = metadata["country"]
-        start_date = metadata["start_date"]
-        end_date = metadata["end_date"]
+    # Query only the SAP_ID column
+    query = "SELECT SAP_ID FROM aws.end_customer"
+    with metrics.dependency("sql", "end_customer_query"):
+        sap_ids_df = pd.read_sql(query, conn)
+    conn.close()
 
+    consolidation_df = pd.DataFrame({"SAP ID": sap_ids_df['SAP_ID'].tolist()})
 
-        Billing_report = pd.read_csv("latest_report.csv", dtype={"Account": str})
+    consolidation_df["Condition Creation/ Country"]="Creation By End Customer"
 
+    consolidation_unique = consolidation_df[["SAP ID","Condition Creation/ Country"
+                    ]].drop_duplicates()
+    
+    consolidation_unique['SAP ID'] = to_key(consolidation_unique['SAP ID'])
 
-        # Connection parameters
-        server = 'bicompute-dwh.database.windows.net'  # or your server name
-        database = 'db-cloudbi'
-        username = 'tdadmin'
-        password = db_password
-        driver = '{ODBC Driver 18 for SQL Server}'
+    consolidation_unique = consolidation_unique[
+        consolidation_unique['SAP ID'] != MISSING_KEY
+    ].drop_duplicates()
 
-        conn = pyodbc.connect(f'DRIVER={driver};SERVER={server};DATABASE={database};UID={username};PWD={password}')
 
-        # Query only the SAP_ID column
-        query = "SELECT SAP_ID FROM aws.end_customer"
+    consolidation_unique['Condition Creation/ Country'] = (
+        consolidation_unique['Condition Creation/ Country'].str.strip()
+        )
 
-        # Load into a DataFrame
-        sap_ids_df = pd.read_sql(query, conn)
+    return consolidation_unique
 
-        # Optional: if you want a single column as a list for your consolidation
-        sap_ids_list = sap_ids_df['SAP_ID'].tolist()
 
-        Billing_report["SAP_ID"] = Billing_report["SAP_ID"].replace("", pd.NA)  # turn empty strings into NaN
-        Billing_report["SAP_ID"] = Billing_report["SAP_ID"].fillna(000000)
+# -----------------------------
+# Prefetched reference data
+# -----------------------------
+# Refreshed by the prefetch leader (PREFETCH=1) ahead of use. Intervals and
+# max ages are in seconds; past its max age an entry is fetched live again.
+PREFETCH_TOKEN_SECONDS = float(os.environ.get("PREFETCH_TOKEN_SECONDS", 300))
+PREFETCH_EMEA_SECONDS = float(os.environ.get("PREFETCH_EMEA_SECONDS", 900))
+PREFETCH_EMEA_MAX_AGE = float(os.environ.get("PREFETCH_EMEA_MAX_AGE", 3600))
+PREFETCH_END_CUSTOMERS_SECONDS = float(os.environ.get("PREFETCH_END_CUSTOMERS_SECONDS", 900))
+PREFETCH_END_CUSTOMERS_MAX_AGE = float(os.environ.get("PREFETCH_END_CUSTOMERS_MAX_AGE", 1800))
 
-        Billing_report = Billing_report[Billing_report['SAP_ID'].notna()]
+# Countries whose tokens are kept fresh (comma separated); EMEA always is
+PREFETCH_COUNTRIES = [c.strip() for c in os.environ.get("PREFETCH_COUNTRIES", "").split(",") if c.strip()]
 
-        # Build your consolidation DataFrame
-        consolidation_df = pd.DataFrame({"SAP ID": sap_ids_list})
 
-        query = "SELECT SAP_ID FROM aws.end_customer"
-        sap_ids_df = pd.read_sql(query, conn)
-        consolidation_df = pd.DataFrame({"SAP ID": sap_ids_df['SAP_ID'].tolist()})
+def prefetch_tokens():
+    """
+    Refresh the stored tokens that are past half their max age, so
+    requests always find one they can use.
+    """
+    configs = [emea_cfg["EMEA"]] + [country_cfg[c] for c in PREFETCH_COUNTRIES if c in country_cfg]
+    for cfg in configs:
+        secret_json = get_token_secret(cfg)
+        refreshed_at = secret_json.get("refreshed_at") or 0
+        if time.time() - refreshed_at >= prefetch.TOKEN_MAX_AGE_SECONDS / 2:
+            refresh_token(cfg, secret_json)
 
-        consolidation_df["Condition Creation/ Country"]="Creation By End Customer"
 
-        consolidation_unique = consolidation_df[["SAP ID","Condition Creation/ Country"
-                        ]].drop_duplicates()
-        
-        consolidation_unique['SAP ID'] = consolidation_unique['SAP ID'].astype('Int64')
+def prefetch_emea():
+    [(status, data)] = fetch_reports([(emea_cfg["EMEA"],) + emea_range()])
+    if status != 200:
+        raise RuntimeError(f"EMEA failed: HTTP {status} - {data}")
+    final_df = emea_mapping(read_report_results(data))
+    if final_df is not None:
+        prefetch.store("emea", final_df)
 
 
-        consolidation_unique['Condition Creation/ Country'] = (
-            consolidation_unique['Condition Creation/ Country'].str.strip()
-            )
-        
-        
-        Billing_report = pd.merge(
-            Billing_report,
-            consolidation_unique,
-            left_on=['SAP_ID'],
-            right_on=['SAP ID'],
-            how='left'
-            )
-        
-        Billing_report['Condition Creation/ Country'] = Billing_report['Condition Creation/ Country'].fillna('Creation by Reseller')
+def prefetch_end_customers():
+    # dropped if amend_sap_consolidation changes the table meanwhile
+    generation = prefetch.generation("end_customers")
+    prefetch.store("end_customers", query_end_customer_ids(), generation)
+
+
+prefetch.schedule("tokens", PREFETCH_TOKEN_SECONDS, prefetch_tokens)
+prefetch.schedule("emea", PREFETCH_EMEA_SECONDS, prefetch_emea)
+prefetch.schedule("end_customers", PREFETCH_END_CUSTOMERS_SECONDS, prefetch_end_customers)
 
 
-        Billing_report["Account"] = Billing_report["Account"].str.zfill(12)
-        # If SAP_ID must also be integer:
-        Billing_report["SAP_ID"] = Billing_report["SAP_ID"].astype("Int64")
+# -----------------------------
+# Material rules
+# -----------------------------
+# SAP material of a report row, from its product name: the first rule whose
+# pattern (a case-insensitive regular expression) is found in the name wins,
+# anything else gets DEFAULT_MATERIAL_ID. MATERIAL_RULES can replace the
+# table with a JSON list of [pattern, material id] pairs.
+material_rules = [
+    ("TechCARE", 11532184),
+]
+DEFAULT_MATERIAL_ID = 6688949
 
-        if "PO" not in Billing_report.columns:
-            Billing_report["PO"] = np.nan 
-            
-        Billing_report['PO'] = Billing_report['PO'].fillna('NaN')
-        Billing_report['End_Customer'] = Billing_report['End_Customer'].fillna('unknown')
+if os.environ.get("MATERIAL_RULES"):
+    material_rules = [(pattern, int(material)) for pattern, material in json.loads(os.environ["MATERIAL_RULES"])]
 
-        if "Condition Creation/ Country" not in Billing_report.columns:
-            Billing_report["Condition Creation/ Country"] = "creation by reseller"
+compiled_material_rules = [(re.compile(pattern, re.IGNORECASE), material) for pattern, material in material_rules]
 
-        if "SAP ID" in Billing_report.columns:  # drop only if column exists
-            Billing_report = Billing_report.drop('SAP ID', axis=1)
-            
-            
-        selected_cols = ['Reseller Name', 'Account', 'SAP_ID', 'Seller Cost', "Materials",'Customer Cost',
-                         'End_Customer', 'PO', 'Condition Creation/ Country']
-        
-        Billing_report = Billing_report[selected_cols]
 
-        Billing_report['Material_id'] = np.where(
-            Billing_report['Materials'].str.contains('TechCARE', case=False, na=False),
-            11532184,
-            6688949)
+def material_id(name):
+    for pattern, material in compiled_material_rules:
+        if pattern.search(name):
+            return material
+    return DEFAULT_MATERIAL_ID
 
-        # Convert to datetime and format
-        start_fmt = pd.to_datetime(start_date).strftime("%m/%d/%y")
-        end_fmt = pd.to_datetime(end_date).strftime("%m/%d/%y")
-        billing_period_str = f"{start_fmt} to {end_fmt}"
 
-        Billing_report["Billing period"] = billing_period_str
-        Billing_report['Condition Creation/ Country'] = Billing_report['Condition Creation/ Country'].str.lower()
+def material_ids(materials):
+    """
+    Material IDs of a column of product names. The rules run once per
+    distinct name and the result is broadcast back through the codes.
+    """
+    codes, names = pd.factorize(materials)
+    # code -1 (missing name) picks the trailing default
+    ids = np.array([material_id(str(name)) for name in names] + [DEFAULT_MATERIAL_ID], dtype="int64")
+    return ids[codes]
 
-        
 
-        # Split DataFrames
-        reseller_df = Billing_report[Billing_report['Condition Creation/ Country'] == 'creation by reseller'].drop(columns=["End_Customer"])
-        end_customer_df = Billing_report[Billing_report['Condition Creation/ Country'] == 'creation by end customer']
+def billing_period(start_date, end_date):
+    # Convert to datetime and format
+    start_fmt = pd.to_datetime(start_date).strftime("%m/%d/%y")
+    end_fmt = pd.to_datetime(end_date).strftime("%m/%d/%y")
+    return f"{start_fmt} to {end_fmt}"
 
-        # Group reseller
-        grouped_reseller = (
-            reseller_df.groupby(['SAP_ID', "Billing period", "Material_id", "PO", 'Condition Creation/ Country'], as_index=False)
-                       .agg({"Seller Cost": "sum", "Customer Cost": "sum"})
-        )
 
-        # Group end customer
-        grouped_end_customer = (
-            end_customer_df.groupby(['SAP_ID', 'Condition Creation/ Country', 'PO',
-                                     'Material_id', "Billing period", "End_Customer"], as_index=False)
-                           .agg({"Seller Cost": "sum", "Customer Cost": "sum"})
+# Groups are keyed by these columns; End_Customer is only set for SAP IDs
+# consolidated by end customer, so reseller rows group without it.
+GROUP_KEYS = ['SAP_ID', 'Condition Creation/ Country', 'PO', 'Material_id', 'Billing period', 'End_Customer']
+CONDITIONS = ['creation by end customer', 'creation by reseller']
+
+
+@metrics.stage("consolidation_prepare")
+def prepare_consolidation(Billing_report, consolidation_unique, start_date, end_date):
+    """
+    Reduce report rows to the group keys and costs: creation condition,
+    PO, material, billing period and (for end customer SAP IDs) the end
+    customer. Builds one new frame; the report itself is not copied.
+    """
+    end_customer = Billing_report['SAP_ID'].isin(consolidation_unique['SAP ID']).to_numpy()
+    rows = len(Billing_report)
+
+    if "PO" in Billing_report.columns:
+        po = Billing_report['PO'].fillna('NaN')
+    else:
+        po = 'NaN'
+
+    return pd.DataFrame({
+        'SAP_ID': Billing_report['SAP_ID'],
+        # one-byte codes instead of a column of strings
+        'Condition Creation/ Country': pd.Categorical.from_codes((~end_customer).astype("int8"), CONDITIONS),
+        'PO': po,
+        'Material_id': material_ids(Billing_report['Materials']),
+        'Billing period': pd.Categorical.from_codes(np.zeros(rows, dtype="int8"),
+                                                    [billing_period(start_date, end_date)]),
+        'End_Customer': Billing_report['End_Customer'].fillna('unknown').where(end_customer),
+        'Seller Cost': Billing_report['Seller Cost'],
+        'Customer Cost': Billing_report['Customer Cost'],
+    })
+
+
+@metrics.stage("consolidation_group")
+def group_consolidation(Billing_report):
+    """
+    Sum costs per reseller / end customer group, in one groupby. Grouping is
+    idempotent, so this also merges previously grouped rows with freshly
+    prepared ones. Groups are ordered end customer groups first, each block
+    sorted by its keys.
+    """
+    groups = (
+        Billing_report.groupby(GROUP_KEYS, sort=False, dropna=False, observed=True)[MONEY_COLUMNS]
+                      .sum()
+                      .reset_index()
+    )
+    groups = groups.astype({'Condition Creation/ Country': object, 'Billing period': object})
+
+    reseller = groups['Condition Creation/ Country'] == 'creation by reseller'
+    order = groups.assign(
+        _reseller=reseller,
+        _end_customer_po=groups['PO'].where(~reseller, ''),
+    ).sort_values(['_reseller', 'SAP_ID', '_end_customer_po', 'Material_id', 'PO', 'End_Customer']).index
+    return groups.loc[order].reset_index(drop=True)
+
+
+@metrics.stage("consolidation_format")
+def format_consolidation(groups):
+    """
+    Turn grouped costs into the consolidated report layout.
+    """
+    po = groups['PO'].replace('NaN', '')
+    empty = pd.Series('', index=groups.index)
+
+    return pd.DataFrame({
+        'Reseller Name': groups['SAP_ID'],
+        'Account': empty,
+        'End Customer': groups['End_Customer'],
+        'Materials': groups['Material_id'],
+        'Seller Cost': from_cents(groups['Seller Cost']),
+        'Customer Cost': from_cents(groups['Customer Cost']),
+        'Margin': from_cents(groups['Customer Cost'] - groups['Seller Cost']),
+        'Usage': empty,
+        'Billing period': groups['Billing period'],
+        'Creation Condition': groups['Condition Creation/ Country'],
+        'Material Not Created': empty,
+        'PO': po,
+        'PO Condition': np.where(po != '', 'PO header', ''),
+        'Sales Order Number': empty,
+        'Billing Block': empty,
+    })
+
+
+def group_report(Billing_report, consolidation_unique, start_date, end_date):
+    """
+    Group a whole detail report (a frame, or the path of a report CSV) with
+    the configured backend.
+    """
+    if not consolidation_sql.enabled():
+        if not isinstance(Billing_report, pd.DataFrame):
+            Billing_report = load_report(Billing_report)
+        return group_consolidation(
+            prepare_consolidation(Billing_report, consolidation_unique, start_date, end_date)
         )
 
-        # Merge
-        Billing_report = pd.concat([grouped_end_customer, grouped_reseller], ignore_index=True)
-        Billing_report['PO'] = Billing_report['PO'].replace('NaN', '')
-        Billing_report['PO Condition'] = np.where(Billing_report['PO'] != '', 'PO header', '')
-
-        # Add empty columns
-        Billing_report['Account'] = ''
-        Billing_report['Usage'] = ''
-        Billing_report['Material Not Created'] = ''
-        Billing_report['Sales Order Number'] = ''
-        Billing_report['Billing Block'] = ''
-
-        # Margin
-        Billing_report['Margin'] = Billing_report['Customer Cost'] - Billing_report['Seller Cost']
-
-        # Rename columns
-        Billing_report.rename(columns={
-            'SAP_ID': 'Reseller Name',
-            'Condition Creation/ Country': 'Creation Condition',
-            'Material_id': 'Materials',
-            'End_Customer': 'End Customer'
-        }, inplace=True)
-
-        # Calculate sums for summary
-        seller_sum = Billing_report["Seller Cost"].sum()
-        customer_sum = Billing_report["Customer Cost"].sum()
-
-        Billing_report["Seller Cost"] = pd.to_numeric(Billing_report["Seller Cost"], errors='coerce').round(2)
-        Billing_report["Customer Cost"] = pd.to_numeric(Billing_report["Customer Cost"], errors='coerce').round(2)
-        Billing_report["Margin"] = pd.to_numeric(Billing_report["Margin"], errors='coerce').round(2)
-
-        # Reorder columns
-        Billing_report = Billing_report[[
-            'Reseller Name',
-            'Account',
-            'End Customer',
-            'Materials',
-            'Seller Cost',
-            'Customer Cost',
-            'Margin',
-            'Usage',
-            'Billing period',
-            'Creation Condition',
-            'Material Not Created',
-            'PO',
-            'PO Condition',
-            'Sales Order Number',
-            'Billing Block'
-        ]]
-
-        # Save latest version
-        Billing_report.to_csv("latest_report.csv", index=False)
+    return consolidation_sql.group_report(
+        Billing_report, consolidation_unique, billing_period(start_date, end_date), material_ids
+    )
+
+
+def consolidate_report(Billing_report, consolidation_unique, start_date, end_date):
+    """
+    Full consolidation of a detail report, in memory.
+    """
+    return format_consolidation(group_report(Billing_report, consolidation_unique, start_date, end_date))
 
-        
+
+# -----------------------------
+# Incremental consolidation state
+# -----------------------------
+# After a consolidation the detail rows move to detail_csv and the per-group
+# sums are kept in consolidation_state_file. Adjustments uploaded afterwards
+# record the SAP IDs they touched in consolidation_dirty_file, so the next
+# consolidation only regroups those SAP IDs.
+
+# Bumped when the layout of the saved groups changes (2: costs in cents)
+CONSOLIDATION_STATE_VERSION = 2
+
+def load_consolidation_state(metadata):
+    """
+    Return the saved group state and dirty SAP IDs, or None when the next
+    consolidation has to start from scratch.
+    """
+    if not (os.path.exists(consolidation_state_file) and os.path.exists(consolidation_dirty_file)):
+        return None
+
+    try:
+        state = pd.read_pickle(consolidation_state_file)
+    except Exception as e:
+        # e.g. written by another pandas version: just recompute
+        print(f"Ignoring unreadable consolidation state: {e}")
+        return None
+    if state.get("version") != CONSOLIDATION_STATE_VERSION or state["metadata"] != metadata:
+        return None
+
+    with open(consolidation_dirty_file) as f:
+        state["dirty"] = set(json.load(f))
+    return state
+
+
+def save_consolidation_state(metadata, consolidation_unique, groups):
+    pd.to_pickle(
+        {"version": CONSOLIDATION_STATE_VERSION, "metadata": metadata,
+         "end_customers": consolidation_unique, "groups": groups},
+        consolidation_state_file
+    )
+    with open(consolidation_dirty_file, "w") as f:
+        json.dump([], f)
+
+
+def mark_dirty(sap_ids):
+    """
+    Record SAP IDs whose rows changed since the last consolidation.
+    """
+    if not os.path.exists(consolidation_dirty_file):
+        return
+
+    with open(consolidation_dirty_file) as f:
+        dirty = set(json.load(f))
+    dirty.update(int(sap_id) for sap_id in pd.unique(pd.Series(sap_ids)))
+    with open(consolidation_dirty_file, "w") as f:
+        json.dump(sorted(dirty), f)
+
+
+def reset_consolidation(keep_detail=True):
+    """
+    Drop the saved group state; with keep_detail=False also forget the
+    detail rows (a new report was fetched).
+    """
+    paths = [consolidation_state_file, consolidation_dirty_file]
+    if not keep_detail:
+        paths.append(detail_csv)
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def consolidation():
+    global  last_country, last_start_date, last_end_date
+
+    try:
+
+        # Reload metadata
+        with open("metadata.json") as f:
+            metadata = json.load(f)
+
+        country = metadata["country"]
+        start_date = metadata["start_date"]
+        end_date = metadata["end_date"]
+
+
+        state = load_consolidation_state(metadata)
+
+        if state is not None:
+            Billing_report = load_report()
+
+            # Only regroup the SAP IDs touched since the last consolidation
+            consolidation_unique = state["end_customers"]
+            kept = state["groups"][~state["groups"]["SAP_ID"].isin(state["dirty"])]
+            touched = Billing_report[Billing_report["SAP_ID"].isin(state["dirty"])]
+            prepared = prepare_consolidation(touched, consolidation_unique, start_date, end_date)
+            # with the saved dtypes on both sides, and no empty part, an all-NA
+            # column (e.g. End_Customer of reseller groups) cannot change them
+            parts = [part for part in (kept, prepared.astype(kept.dtypes.to_dict())) if len(part)]
+            groups = group_consolidation(pd.concat(parts or [kept], ignore_index=True))
+        else:
+            # the SQL backend reads the report file itself
+            consolidation_unique = get_end_customer_ids()
+            groups = group_report(working_report_path(), consolidation_unique, start_date, end_date)
+
+        # Keep the detail rows for later adjustments, then save latest version
+        if not os.path.exists(detail_csv):
+            shutil.copyfile(report_csv, detail_csv)
+        save_consolidation_state(metadata, consolidation_unique, groups)
+
+        Billing_report = format_consolidation(groups)
+        save_report(Billing_report, report_csv)
+        metrics.rows("consolidation", len(Billing_report))
 
         return {
             "final_df_message": f"from {start_date} to {end_date} [Consolidated]",
             "country": country,
-            "seller_sum": Billing_report["Seller Cost"].sum(),
-            "customer_sum": Billing_report["Customer Cost"].sum()
+            "seller_sum": total(groups["Seller Cost"]),
+            "customer_sum": total(groups["Customer Cost"])
         }
 
     except Exception as e:
@@ -807,18 +1377,55 @@ def consolidation():
         return {"error": str(e)}
     
 
+# -----------------------------
+# Single-call pipeline
+# -----------------------------
+def run_pipeline(country, start_date, end_date, exceptions=None, credits=None, po_numbers=None):
+    """
+    Fetch, adjust and consolidate a country in one in-memory pass, in the
+    order of the UI steps: exceptions, credits, PO numbers, consolidation.
+    The adjustment frames are optional and must have the upload headers.
+    Nothing is read from or written to the working report files, so this
+    does not touch the state of the step-by-step flow.
+    """
+    for df, expected_headers in ((exceptions, EXCEPTION_HEADERS), (credits, CREDIT_HEADERS),
+                                 (po_numbers, PO_HEADERS)):
+        if df is not None:
+            check_headers(df, expected_headers)
+
+    Billing_report = fetch_billing_report(country, start_date, end_date)
+    if exceptions is not None:
+        Billing_report, _ = exception_adjust(Billing_report, exceptions)
+    if credits is not None:
+        Billing_report, _ = credit_adjust(Billing_report, credits)
+    if po_numbers is not None:
+        Billing_report, _ = po_adjust(Billing_report, po_numbers)
+
+    consolidated = consolidate_report(Billing_report, get_end_customer_ids(), start_date, end_date)
+    metrics.rows("pipeline", len(consolidated))
+
+    return {
+        "final_df_message": f"from {start_date} to {end_date} [Consolidated]",
+        "country": country,
+        "seller_sum": total(Billing_report["Seller Cost"]),
+        "customer_sum": total(Billing_report["Customer Cost"]),
+        "report": consolidated,
+    }
+
+
 # New: function to get BlobServiceClient
 
 def get_blob_service_client():
     conn_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
     if conn_str:
-        return BlobServiceClient.from_connection_string(conn_str)
+        return BlobServiceClient.from_connection_string(conn_str, **resilience.client_options("blob"))
     else:
         # Use managed identity when deployed in Azure
         credential = DefaultAzureCredential()
         return BlobServiceClient(
             account_url="https://awstoolstorage.blob.core.windows.net",
-            credential=credential
+            credential=credential,
+            **resilience.client_options("blob")
         )
     
 def amend_sap_consolidation(uploaded_file):
@@ -826,19 +1433,24 @@ def amend_sap_consolidation(uploaded_file):
     Replace aws.end_customer table content with values from uploaded CSV.
     """
     try:
+        # 1. Check the header row, then load the uploaded file, before the table is touched
+        if not uploaded_file.filename.endswith((".csv", ".xlsx")):
+            return {"error": "Unsupported file type. Please upload a CSV or XLSX."}
+
+        # Ensure column consistency
+        if "SAP ID" not in sniff_columns(uploaded_file):
+            return {"error": "File must contain a column named 'SAP ID'."}
+
+        if uploaded_file.filename.endswith(".csv"):
+            sap_ids_df = pd.read_csv(uploaded_file)
+        else:
+            sap_ids_df = pd.read_excel(uploaded_file)
+
         # --- SQL connection ---
-        server = 'bicompute-dwh.database.windows.net'
-        database = 'db-cloudbi'
-        username = 'tdadmin'
-        driver = '{ODBC Driver 18 for SQL Server}'
-        password= db_password
-
-        conn = pyodbc.connect(
-            f'DRIVER={driver};SERVER={server};DATABASE={database};UID={username};PWD={password}'
-        )
+        conn = db_connect()
         cursor = conn.cursor()
 
-        # 1. Drop & recreate the table
+        # 2. Drop & recreate the table
         cursor.execute("""
             IF OBJECT_ID('aws.end_customer', 'U') IS NOT NULL
                 DROP TABLE aws.end_customer;
@@ -848,18 +1460,6 @@ def amend_sap_consolidation(uploaded_file):
         """)
         conn.commit()
 
-        # 2. Load uploaded CSV into DataFrame
-        if uploaded_file.filename.endswith(".csv"):
-            sap_ids_df = pd.read_csv(uploaded_file)
-        elif uploaded_file.filename.endswith(".xlsx"):
-            sap_ids_df = pd.read_excel(uploaded_file)
-        else:
-            return {"error": "Unsupported file type. Please upload a CSV or XLSX."}
-
-        # Ensure column consistency
-        if "SAP ID" not in sap_ids_df.columns:
-            return {"error": "File must contain a column named 'SAP ID'."}
-
         # 3. Insert new data
         for sap_id in sap_ids_df["SAP ID"].dropna().astype(str).tolist():
             cursor.execute("INSERT INTO aws.end_customer (SAP_ID) VALUES (?)", sap_id)
@@ -867,6 +1467,10 @@ def amend_sap_consolidation(uploaded_file):
         conn.commit()
         conn.close()
 
+        # end-customer SAP IDs changed: the next consolidation regroups everything
+        prefetch.invalidate("end_customers")
+        reset_consolidation()
+
         return {"message": f"Table aws.end_customer refreshed with {len(sap_ids_df)} rows."}
 
     except Exception as e:
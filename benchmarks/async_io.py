@@ -0,0 +1,99 @@
+# benchmarks/async_io.py
+"""
+Throughput of the report fetches (token refreshes plus the country and EMEA
+downloads of one /awstool request) against the local ion stub, sync vs
+async:
+
+    python -m benchmarks.async_io --requests 20 --latency 0.2
+
+  sync        requests one after the other, every call blocking (one sync
+              gunicorn worker)
+  threads     sync requests on --threads threads (one gthread worker)
+  async       requests one after the other, the calls of each request
+              overlapped (ASYNC_IO=1)
+  async-all   every request's calls in flight at once on one event loop
+
+--latency is added by the stub to every ion response; Key Vault is faked in
+memory, so only the ion waits are simulated.
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import stubs
+
+stubs.install()
+
+from loadtest import ion_stub  # noqa: E402
+
+
+def reports():
+    import awstool
+    return [
+        (awstool.country_cfg["FR"], "2025-07-01T00:00:00Z", "2025-07-31T23:59:59Z"),
+        (awstool.emea_cfg["EMEA"], "2024-08-01T00:00:00Z", "2025-07-31T23:59:59Z"),
+    ]
+
+
+def run_sync(requests, threads=1):
+    import aio, awstool
+    aio.ASYNC_IO = False
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(lambda _: awstool.fetch_reports(reports()), range(requests)))
+    return results
+
+
+def run_async(requests):
+    import aio, awstool
+    aio.ASYNC_IO = True
+    return [awstool.fetch_reports(reports()) for _ in range(requests)]
+
+
+def run_async_all(requests):
+    import aio, awstool
+    ion_url = f"{awstool.ION_URL.scheme}://{awstool.ION_URL.netloc}"
+    batch = [(cfg["secret_id"],) + awstool.report_request(cfg, start, end) for cfg, start, end in reports()]
+    return asyncio.run(aio.fetch_all(ion_url, awstool.VAULT_URL, batch * requests))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20, help="simulated /awstool requests per mode")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds the stub adds to every ion response")
+    parser.add_argument("--rows", type=int, default=2000, help="rows in the stub's country report")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args(argv)
+
+    # awstool reads ION_URL when it is imported
+    os.environ["ION_URL"] = f"http://127.0.0.1:{args.port}"
+    server = ion_stub.serve(args.port, args.rows, args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    import aio
+    modes = {"sync": lambda: run_sync(args.requests),
+             "threads": lambda: run_sync(args.requests, args.threads)}
+    if aio.aiohttp is not None:
+        modes["async"] = lambda: run_async(args.requests)
+        modes["async-all"] = lambda: run_async_all(args.requests)
+    else:
+        print("aiohttp is not installed: skipping the async modes")
+
+    try:
+        for name, fn in modes.items():
+            started = time.perf_counter()
+            results = fn()
+            seconds = time.perf_counter() - started
+            statuses = {status for result in results for status, _ in
+                        (result if isinstance(result, list) else [result])}
+            print(f"{name:<10} {args.requests} requests in {seconds:7.2f} s  "
+                  f"{args.requests / seconds:7.2f} req/s  (HTTP {sorted(statuses)})", flush=True)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# benchmarks/datagen.py
+"""
+Synthetic inputs shaped like the real billing reports and adjustment files.
+"""
+import io
+import numpy as np
+import pandas as pd
+
+
+MATERIALS = [
+    "Amazon Elastic Compute Cloud",
+    "Amazon Simple Storage Service",
+    "Amazon Relational Database Service",
+    "AWS Lambda",
+    "Amazon CloudFront",
+    "TechCARE Essential",
+    "TechCARE Premium",
+    "AWS Support (Business)",
+]
+
+SAP_HEADER_COLUMNS = [
+    "Header ID", "Sold-To", "Ship-To", "Sales Org", "Distribution Channel",
+    "Division", "Order Type", "Customer PO", "Billing Date", "Currency",
+]
+SAP_LINE_COLUMNS = ["Line ID", "Material", "Quantity", "Sale Price", "Cost Price", "Description"]
+
+
+def _accounts(rows):
+    return max(rows // 20, 10)
+
+
+def _sap_ids(rows):
+    return max(rows // 200, 5)
+
+
+def billing_report(rows, seed=0):
+    """
+    A report as run_awstool saves it to latest_report.csv.
+    """
+    rng = np.random.default_rng(seed)
+    accounts = rng.integers(10**10, 10**12, _accounts(rows))
+    sap_ids = np.arange(100000, 100000 + _sap_ids(rows))
+    account = rng.choice(accounts, rows)
+
+    seller = rng.gamma(2.0, 40.0, rows).round(2)
+    return pd.DataFrame({
+        "Reseller Name": rng.choice([f"Reseller {i}" for i in range(50)], rows),
+        "Account": pd.Series(account).astype(str).str.zfill(12),
+        "SAP_ID": sap_ids[account % len(sap_ids)],
+        "Materials": rng.choice(MATERIALS, rows),
+        "Usage Type": rng.choice(["BoxUsage", "TimedStorage", "DataTransfer-Out", "Requests"], rows),
+        "Seller Cost": seller,
+        "Customer Cost": (seller * rng.uniform(1.02, 1.25, rows)).round(2),
+        "Country": "FR",
+        "End_Customer": np.where(rng.random(rows) < 0.1, None,
+                                 pd.Series(account % 997).map(lambda i: f"End Customer {i}")),
+    })
+
+
+def ion_country_report(rows, seed=0):
+    """
+    A country reportDataCsv export as ion returns it (before run_awstool
+    renames and merges it).
+    """
+    report = billing_report(rows, seed)
+    return pd.DataFrame({
+        "Reseller Name": report["Reseller Name"],
+        "Cloud Account Number": report["Account"].astype("int64"),
+        "SAP ID (customer)": report["SAP_ID"],
+        "Product Name": report["Materials"],
+        "Usage Type": report["Usage Type"],
+        "Seller Cost (EUR)": report["Seller Cost"],
+        "Customer Cost (EUR)": report["Customer Cost"],
+        "Margin (EUR)": (report["Customer Cost"] - report["Seller Cost"]).round(2),
+    })
+
+
+def ion_emea_report(rows, seed=0):
+    """
+    The rolling EMEA export mapping accounts to their end customer.
+    """
+    report = billing_report(rows, seed)
+    accounts = report.drop_duplicates("Account")
+    return pd.DataFrame({
+        "Account Number": accounts["Account"].astype("int64"),
+        "Assigned Customer Company": accounts["End_Customer"],
+    })
+
+
+def end_customer_ids(report, share=0.3, seed=0):
+    """
+    A share of the report's SAP IDs, as stored in aws.end_customer.
+    """
+    rng = np.random.default_rng(seed)
+    sap_ids = np.unique(report["SAP_ID"])
+    return sorted(rng.choice(sap_ids, max(int(len(sap_ids) * share), 1), replace=False).tolist())
+
+
+def exceptions(report, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    accounts = rng.choice(report["Account"].unique(), rows)
+    return pd.DataFrame({
+        "SAP ID": rng.choice(report["SAP_ID"].unique(), rows),
+        "Account": accounts,
+    })
+
+
+def credits(report, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "Account": rng.choice(report["Account"].unique(), rows, replace=False),
+        "Credit": rng.gamma(2.0, 50.0, rows).round(2),
+    })
+
+
+def po_numbers(report, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    pairs = report[["SAP_ID", "Account"]].drop_duplicates().sample(rows, random_state=seed)
+    return pd.DataFrame({
+        "Reseller SAP ID": pairs["SAP_ID"].to_numpy(),
+        "End Customer": pairs["Account"].to_numpy(),
+        "PO": [f"PO-{i:06d}" for i in rng.integers(0, 10**6, rows)],
+        "PO Condition": "PO header",
+    })
+
+
+def sap_workbook(rows, lines_per_header=5, seed=0):
+    """
+    An SAP upload as /upload reads it (all columns as strings): ten header
+    columns followed by the line columns.
+    """
+    rng = np.random.default_rng(seed)
+    header_ids = np.arange(rows) // lines_per_header + 1
+    headers = pd.DataFrame({
+        "Header ID": header_ids,
+        "Sold-To": 100000 + header_ids % 500,
+        "Ship-To": 100000 + header_ids % 500,
+        "Sales Org": "FR01",
+        "Distribution Channel": "10",
+        "Division": "00",
+        "Order Type": "ZCLD",
+        "Customer PO": [f"PO, {i}" for i in header_ids],
+        "Billing Date": "20250731",
+        "Currency": "EUR",
+    })
+    lines = pd.DataFrame({
+        "Line ID": header_ids,
+        "Material": rng.choice(["6688949", "11532184"], rows),
+        "Quantity": "1",
+        "Sale Price": rng.gamma(2.0, 40.0, rows).round(4),
+        "Cost Price": rng.gamma(2.0, 35.0, rows).round(4),
+        "Description": rng.choice(MATERIALS, rows),
+    })
+    return pd.concat([headers, lines], axis=1).astype(str)
+
+
+def adjustment_rows(rows):
+    """
+    Rows in an exception / credit / PO file for a report of `rows` rows.
+    """
+    return min(max(rows // 100, 10), 5000)
+
+
+def to_upload(df, filename):
+    """
+    Wrap a frame as an uploaded CSV file, as the Flask routes pass it on.
+    """
+    from werkzeug.datastructures import FileStorage
+    return FileStorage(stream=io.BytesIO(df.to_csv(index=False).encode("utf-8")), filename=filename)
@@ -0,0 +1,249 @@
+# benchmarks/run.py
+"""
+Micro-benchmarks for the pandas hot paths, runnable offline.
+
+    python -m benchmarks.run                          # 10k and 100k rows
+    python -m benchmarks.run --sizes 10k,100k,1m
+    python -m benchmarks.run --only consolidation --repeat 5
+    python -m benchmarks.run --only consolidation,consolidation_sql --sizes 1m
+    python -m benchmarks.run --update-baseline        # store results as the baseline
+
+Each benchmark is timed on its own (best of --repeat) and then run once more
+under tracemalloc for its peak memory. Results are compared with
+benchmarks/baseline.json; anything slower or bigger than the baseline by more
+than --tolerance is reported and the run exits with status 1.
+
+The committed baseline.json is a reference taken on a single-core runner at
+the default sizes. Peak memory carries over between machines, timings do
+not: in CI, run --update-baseline on the main branch on the runner itself
+(and cache the file) before comparing pull requests against it.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import datagen, stubs
+
+stubs.install()
+
+import awstool  # noqa: E402
+import consolidation_sql  # noqa: E402
+from app import transform_sap  # noqa: E402
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+METADATA = {"country": "FR", "start_date": "2025-07-01", "end_date": "2025-07-31"}
+
+# transform_sap quotes every cell in Python (about 11 s per million rows), so
+# it is left out of the larger sizes to keep --sizes 1m runs short
+MAX_ROWS = {"transform_sap": 100000}
+
+
+def _check(result):
+    if isinstance(result, dict) and "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+
+class Workspace:
+    """
+    A temporary working directory holding metadata.json and a pristine copy
+    of the synthetic report, restored before every run.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.dir = tempfile.mkdtemp(prefix="awstool-bench-")
+        self.report = datagen.billing_report(rows)
+        stubs.END_CUSTOMER_IDS[:] = datagen.end_customer_ids(self.report)
+
+        self.pristine = os.path.join(self.dir, "pristine_report.csv")
+        self.report.to_csv(self.pristine, index=False)
+        with open(os.path.join(self.dir, "metadata.json"), "w") as f:
+            json.dump(METADATA, f)
+
+    def reset(self):
+        awstool.reset_consolidation(keep_detail=False)
+        shutil.copyfile(self.pristine, awstool.report_csv)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+# -----------------------
+# Benchmarks
+# -----------------------
+# Each entry builds its inputs from a Workspace and returns a callable that
+# runs the function once (setup outside the callable is not measured), or
+# None when the benchmark cannot run here.
+
+def bench_transform_sap(ws):
+    df = datagen.sap_workbook(ws.rows)
+    return lambda: transform_sap(df.copy())
+
+
+def bench_apply_exception(ws):
+    data = datagen.exceptions(ws.report, datagen.adjustment_rows(ws.rows))
+    return lambda: _check(awstool.apply_exception(datagen.to_upload(data, "exceptions.csv")))
+
+
+def bench_apply_credit_adjustments(ws):
+    data = datagen.credits(ws.report, datagen.adjustment_rows(ws.rows))
+    return lambda: _check(awstool.apply_credit_adjustments(datagen.to_upload(data, "credits.csv")))
+
+
+def bench_apply_po_adjustments(ws):
+    data = datagen.po_numbers(ws.report, datagen.adjustment_rows(ws.rows))
+    return lambda: _check(awstool.apply_po_adjustments(datagen.to_upload(data, "po.csv")))
+
+
+def bench_consolidation(ws):
+    return lambda: _check(awstool.consolidation())
+
+
+def bench_consolidation_sql(ws):
+    if consolidation_sql.duckdb is None:
+        return None
+
+    def run():
+        backend = consolidation_sql.CONSOLIDATION_BACKEND
+        consolidation_sql.CONSOLIDATION_BACKEND = "duckdb"
+        try:
+            _check(awstool.consolidation())
+        finally:
+            consolidation_sql.CONSOLIDATION_BACKEND = backend
+    return run
+
+
+BENCHMARKS = {
+    "transform_sap": bench_transform_sap,
+    "apply_exception": bench_apply_exception,
+    "apply_credit_adjustments": bench_apply_credit_adjustments,
+    "apply_po_adjustments": bench_apply_po_adjustments,
+    "consolidation": bench_consolidation,
+    "consolidation_sql": bench_consolidation_sql,
+}
+
+
+# -----------------------
+# Runner
+# -----------------------
+def parse_size(text):
+    text = text.strip().lower()
+    for suffix, factor in (("k", 10**3), ("m", 10**6)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * factor)
+    return int(text)
+
+
+def measure(ws, fn, repeat):
+    """
+    Best wall time over `repeat` runs, then peak traced memory of one run.
+    """
+    times = []
+    for _ in range(repeat):
+        ws.reset()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+
+    ws.reset()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"seconds": min(times), "peak_mb": peak / 2**20}
+
+
+def run(names, sizes, repeat):
+    results = {}
+    cwd = os.getcwd()
+    for rows in sizes:
+        ws = Workspace(rows)
+        os.chdir(ws.dir)
+        try:
+            for name in names:
+                if rows > MAX_ROWS.get(name, rows):
+                    continue
+                key = f"{name}@{rows}"
+                fn = BENCHMARKS[name](ws)
+                if fn is None:
+                    print(f"{key:<36} skipped", flush=True)
+                    continue
+                results[key] = measure(ws, fn, repeat)
+                print(f"{key:<36} {results[key]['seconds']:>9.3f} s {results[key]['peak_mb']:>9.1f} MB", flush=True)
+        finally:
+            os.chdir(cwd)
+            ws.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    List the results that regressed against the baseline by more than
+    `tolerance` (a fraction) in time or peak memory.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ("seconds", "peak_mb"):
+            before, after = baseline[key][metric], result[metric]
+            if before > 0 and (after - before) / before > tolerance:
+                regressions.append(f"{key} {metric}: {before:.3f} -> {after:.3f} (+{(after - before) / before:.0%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10k,100k", help="comma separated row counts, e.g. 10k,100k,1m")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="comma separated benchmark names")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown / growth, as a fraction")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.only.split(",") if name.strip()]
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    results = run(names, [parse_size(size) for size in args.sizes.split(",")], args.repeat)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not baseline:
+        print("No baseline to compare with (run with --update-baseline to create one).")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+# benchmarks/stubs.py
+"""
+Offline stand-ins for Azure Key Vault, Blob Storage and the SQL database.
+
+install() must run before awstool/app are imported: both modules create
+their Azure clients and read the database password at import time.
+"""
+import gzip
+import json
+import sqlite3
+import sys
+import types
+
+
+# SAP IDs served from the fake aws.end_customer table
+END_CUSTOMER_IDS = []
+
+# SQLite file backing aws.end_customer; ":memory:" gives every connection a
+# fresh table seeded from END_CUSTOMER_IDS
+SQLITE_PATH = ":memory:"
+
+
+class _Secret:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeSecretClient:
+    """
+    In-memory Key Vault: API key secrets hold a refresh/access key pair,
+    anything else (database-password) a plain string.
+    """
+    def __init__(self, *args, **kwargs):
+        self.secrets = {}
+
+    def get_secret(self, name):
+        if name not in self.secrets:
+            if name.startswith("api-keys-"):
+                self.secrets[name] = json.dumps({"refresh_key": "stub-refresh", "access_key": "stub-access"})
+            else:
+                self.secrets[name] = "stub-password"
+        return _Secret(self.secrets[name])
+
+    def set_secret(self, name, value):
+        self.secrets[name] = value
+        return _Secret(value)
+
+
+class FakeAsyncSecretClient(FakeSecretClient):
+    """
+    azure.keyvault.secrets.aio stand-in.
+    """
+    async def get_secret(self, name):
+        return FakeSecretClient.get_secret(self, name)
+
+    async def set_secret(self, name, value):
+        return FakeSecretClient.set_secret(self, name, value)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class _Download:
+    def __init__(self, data, content_settings):
+        self.data = data
+        self.properties = types.SimpleNamespace(content_settings=content_settings)
+        self.size = len(data)
+
+    def readall(self):
+        return self.data
+
+    def chunks(self, chunk_size=4 * 2**20):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+
+class FakeBlobClient:
+    def __init__(self, store, container, blob):
+        self.store = store
+        self.key = (container, blob)
+
+    def upload_blob(self, data, overwrite=False, content_settings=None, **kwargs):
+        self.store[self.key] = (data if isinstance(data, bytes) else data.read(),
+                                content_settings or ContentSettings())
+
+    def download_blob(self, decompress=True, **kwargs):
+        # like the SDK, gzip-encoded blobs are decompressed unless decompress=False
+        data, content_settings = self.store[self.key]
+        if decompress and content_settings.content_encoding == "gzip":
+            data = gzip.decompress(data)
+        return _Download(data, content_settings)
+
+
+class FakeBlobServiceClient:
+    """
+    Blob storage kept in a dict keyed by (container, blob).
+    """
+    store = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def from_connection_string(cls, conn_str, **kwargs):
+        return cls()
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self.store, container, blob)
+
+
+class ContentSettings:
+    def __init__(self, content_type=None, content_encoding=None, **kwargs):
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.__dict__.update(kwargs)
+
+
+class DefaultAzureCredential:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class _Connection(sqlite3.Connection):
+    # pyodbc's query timeout attribute
+    timeout = 0
+
+
+def connect(*args, **kwargs):
+    """
+    pyodbc.connect stand-in: SQLite with an `aws` schema holding
+    end_customer(SAP_ID) filled from END_CUSTOMER_IDS.
+    """
+    conn = sqlite3.connect(":memory:", check_same_thread=False, factory=_Connection)
+    conn.execute("ATTACH DATABASE ? AS aws", (SQLITE_PATH,))
+    exists = conn.execute(
+        "SELECT 1 FROM aws.sqlite_master WHERE type = 'table' AND name = 'end_customer'").fetchone()
+    if not exists:
+        conn.execute("CREATE TABLE aws.end_customer (SAP_ID TEXT)")
+        conn.executemany("INSERT INTO aws.end_customer (SAP_ID) VALUES (?)",
+                         [(str(sap_id),) for sap_id in END_CUSTOMER_IDS])
+        conn.commit()
+    return conn
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install(end_customer_ids=(), sqlite_path=":memory:", fake_blob=True):
+    """
+    Register the fake Key Vault and pyodbc modules in sys.modules. With
+    fake_blob=False the real azure-storage-blob package is kept, e.g. to
+    talk to Azurite through AZURE_STORAGE_CONNECTION_STRING.
+    """
+    global SQLITE_PATH
+    END_CUSTOMER_IDS[:] = list(end_customer_ids)
+    SQLITE_PATH = sqlite_path
+
+    if fake_blob:
+        _module("azure", __path__=[])
+        _module("azure.identity", __path__=[], DefaultAzureCredential=DefaultAzureCredential)
+        _module("azure.identity.aio", DefaultAzureCredential=DefaultAzureCredential)
+        _module("azure.storage", __path__=[])
+        _module("azure.storage.blob", BlobServiceClient=FakeBlobServiceClient, ContentSettings=ContentSettings)
+    else:
+        import azure.storage.blob  # noqa: F401  (the real package must be installed)
+    _module("azure.keyvault", __path__=[])
+    _module("azure.keyvault.secrets", __path__=[], SecretClient=FakeSecretClient)
+    _module("azure.keyvault.secrets.aio", SecretClient=FakeAsyncSecretClient)
+    _module("pyodbc", connect=connect, Error=sqlite3.Error, OperationalError=sqlite3.OperationalError)
@@ -0,0 +1,152 @@
+# consolidation_sql.py
+"""
+Consolidation grouping run as one SQL query in an embedded DuckDB database,
+as an alternative to the pandas merges and groupbys of
+awstool.prepare_consolidation / group_consolidation.
+
+Enabled with CONSOLIDATION_BACKEND=duckdb; needs the duckdb package. The
+query reads the working report CSV itself (typed as load_report types it),
+so a full consolidation no longer loads the detail rows into pandas, and it
+returns the same groups frame as the pandas path, which the incremental
+consolidation state and format_consolidation keep using.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+CONSOLIDATION_BACKEND = os.environ.get("CONSOLIDATION_BACKEND", "pandas")
+
+# DuckDB threads per query; empty keeps DuckDB's default (one per core)
+DUCKDB_THREADS = os.environ.get("DUCKDB_THREADS")
+
+if CONSOLIDATION_BACKEND == "duckdb" and duckdb is None:
+    print("CONSOLIDATION_BACKEND=duckdb but duckdb is not installed: consolidation stays on pandas")
+
+# Strings pandas.read_csv reads as missing values
+NA_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+             "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+
+MONEY_COLUMNS = ["Seller Cost", "Customer Cost"]
+
+
+def enabled():
+    return CONSOLIDATION_BACKEND == "duckdb" and duckdb is not None
+
+
+def _literal(text):
+    return "'" + str(text).replace("'", "''") + "'"
+
+
+def _csv_relation(con, path):
+    """
+    SQL selecting the report CSV with the columns typed as load_report
+    types them: SAP_ID as int64 key (0 when invalid), costs as cents.
+    """
+    nullstr = "[" + ", ".join(_literal(value) for value in NA_VALUES) + "]"
+    source = f"read_csv({_literal(path)}, header = true, all_varchar = true, nullstr = {nullstr})"
+    columns = con.execute(f"SELECT * FROM {source} LIMIT 0").fetchdf().columns
+
+    money = ", ".join(
+        f'CAST(round_even(TRY_CAST("{column}" AS DOUBLE) * 100, 0) AS BIGINT) AS "{column}"'
+        for column in MONEY_COLUMNS
+    )
+    return f"""
+        SELECT
+            coalesce(TRY_CAST(trunc(TRY_CAST(SAP_ID AS DOUBLE)) AS BIGINT), 0) AS SAP_ID,
+            Materials,
+            {"PO" if "PO" in columns else "CAST(NULL AS VARCHAR)"} AS PO,
+            End_Customer,
+            {money}
+        FROM {source}
+    """
+
+
+def _frame_relation(report):
+    """
+    SQL selecting a report already loaded with load_report (registered as
+    the `report_frame` view).
+    """
+    return f"""
+        SELECT SAP_ID, Materials, {"CAST(PO AS VARCHAR)" if "PO" in report.columns else "CAST(NULL AS VARCHAR)"} AS PO,
+               End_Customer, "Seller Cost", "Customer Cost"
+        FROM report_frame
+    """
+
+
+GROUP_QUERY = """
+    WITH prepared AS (
+        SELECT
+            r.SAP_ID,
+            lower(coalesce(c."Condition Creation/ Country", 'Creation by Reseller')) AS condition,
+            coalesce(r.PO, 'NaN') AS PO,
+            m.Material_id,
+            -- reseller groups do not split by end customer
+            CASE WHEN condition = 'creation by end customer' THEN coalesce(r.End_Customer, 'unknown') END
+                AS End_Customer,
+            r."Seller Cost" AS seller,
+            r."Customer Cost" AS customer
+        FROM report r
+        LEFT JOIN end_customers c ON r.SAP_ID = c."SAP ID"
+        JOIN materials m ON r.Materials IS NOT DISTINCT FROM m.Materials
+    )
+    SELECT
+        SAP_ID,
+        condition AS "Condition Creation/ Country",
+        PO,
+        Material_id,
+        {period} AS "Billing period",
+        End_Customer,
+        CAST(coalesce(sum(seller), 0) AS BIGINT) AS "Seller Cost",
+        CAST(coalesce(sum(customer), 0) AS BIGINT) AS "Customer Cost"
+    FROM prepared
+    WHERE condition IN ('creation by end customer', 'creation by reseller')
+    GROUP BY SAP_ID, condition, PO, Material_id, End_Customer
+    -- the pandas order: end customer groups first, each block sorted by its groupby keys
+    ORDER BY condition = 'creation by reseller', SAP_ID,
+             CASE WHEN condition = 'creation by end customer' THEN PO END,
+             Material_id, PO, End_Customer
+"""
+
+
+def group_report(report, consolidation_unique, billing_period, material_ids):
+    """
+    Group a report (path of the working report CSV, or a frame from
+    load_report) like awstool.group_consolidation(prepare_consolidation(...)).
+    material_ids maps product names to material IDs (awstool.material_ids);
+    it is only called on the distinct names, which are then joined back.
+    """
+    con = duckdb.connect()
+    try:
+        if DUCKDB_THREADS:
+            con.execute(f"SET threads = {int(DUCKDB_THREADS)}")
+        con.register("end_customers", consolidation_unique)
+
+        if isinstance(report, pd.DataFrame):
+            con.register("report_frame", report)
+            relation = _frame_relation(report)
+        else:
+            relation = _csv_relation(con, report)
+
+        with metrics.stage("consolidation_sql"):
+            con.execute(f"CREATE TEMP TABLE report AS {relation}")
+
+            materials = con.execute("SELECT DISTINCT Materials FROM report").fetchdf()
+            materials["Material_id"] = material_ids(materials["Materials"])
+            con.register("materials", materials)
+
+            groups = con.execute(GROUP_QUERY.format(period=_literal(billing_period))).fetchdf()
+    finally:
+        con.close()
+
+    # same dtypes as the pandas groups, so both can be mixed in the saved state
+    groups["End_Customer"] = groups["End_Customer"].astype(object).where(groups["End_Customer"].notna(), np.nan)
+    return groups.astype({column: "Int64" for column in MONEY_COLUMNS})
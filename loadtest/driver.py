@@ -0,0 +1,197 @@
+# loadtest/driver.py
+"""
+Concurrent driver for the awstool flow:
+
+    /awstool -> /upload_exception -> /upload_credits -> /upload_po
+             -> /consolidation -> /download_csv
+
+    python -m loadtest.driver --url http://127.0.0.1:8000 --users 20 --iterations 5
+
+Every simulated user runs the whole flow --iterations times. The adjustment
+files are built from the same synthetic report the ion stub serves, so use
+the same --rows for both. Prints throughput and p50/p95/p99 latency per step.
+
+The app keeps the working report in files in its current directory, so
+concurrent users overwrite each other's report and an adjustment step can
+read a report another worker is halfway through writing (counted as
+"error in page"). This measures the load the flow puts on the server, not
+the correctness of interleaved sessions.
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import datagen
+
+
+STEPS = ["awstool", "upload_exception", "upload_credits", "upload_po", "consolidation", "download_csv"]
+
+# awstool.html renders a failed step as "Error: ..." with a 200 status
+ERROR_MARKER = b'<p style="color:red;">Error:'
+
+
+def multipart(fields, files):
+    """
+    Encode form fields and {name: (filename, bytes)} files as multipart/form-data.
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: text/csv\r\n\r\n'.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Flow:
+    """
+    The requests of one pass through the flow, built once and shared by all
+    users.
+    """
+    def __init__(self, base_url, rows, country, start_date, end_date, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        report = datagen.billing_report(rows)
+        adjustments = datagen.adjustment_rows(rows)
+
+        def upload(df, filename):
+            return multipart({}, {"file": (filename, df.to_csv(index=False).encode("utf-8"))})
+
+        self.requests = {
+            "awstool": multipart({"country": country, "start_date": start_date, "end_date": end_date}, {}),
+            "upload_exception": upload(datagen.exceptions(report, adjustments), "exceptions.csv"),
+            "upload_credits": upload(datagen.credits(report, adjustments), "credits.csv"),
+            "upload_po": upload(datagen.po_numbers(report, adjustments), "po.csv"),
+            "consolidation": (None, None),
+            "download_csv": (None, None),
+        }
+
+    def call(self, step):
+        """
+        Run one step; returns (seconds, error or None).
+        """
+        body, content_type = self.requests[step]
+        req = urllib.request.Request(f"{self.base_url}/{step}", data=body,
+                                     headers={"Content-Type": content_type} if content_type else {})
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                data = resp.read()
+            error = "error in page" if ERROR_MARKER in data else None
+        except urllib.error.HTTPError as e:
+            error = f"HTTP {e.code}"
+        except Exception as e:
+            error = type(e).__name__
+        return time.perf_counter() - started, error
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {step: [] for step in STEPS}
+        self.errors = {step: {} for step in STEPS}
+        self.flows = 0
+
+    def add(self, step, seconds, error):
+        with self.lock:
+            self.latencies[step].append(seconds)
+            if error:
+                self.errors[step][error] = self.errors[step].get(error, 0) + 1
+
+    def summary(self, elapsed):
+        steps = {}
+        for step in STEPS:
+            latencies = self.latencies[step]
+            if not latencies:
+                continue
+            steps[step] = {
+                "requests": len(latencies),
+                "errors": sum(self.errors[step].values()),
+                "error_kinds": self.errors[step],
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": max(latencies),
+            }
+        requests = sum(s["requests"] for s in steps.values())
+        return {
+            "elapsed_seconds": elapsed,
+            "flows": self.flows,
+            "flows_per_second": self.flows / elapsed if elapsed else 0.0,
+            "requests_per_second": requests / elapsed if elapsed else 0.0,
+            "steps": steps,
+        }
+
+
+def run_user(flow, results, iterations):
+    for _ in range(iterations):
+        for step in STEPS:
+            seconds, error = flow.call(step)
+            results.add(step, seconds, error)
+            if error and step == "awstool":
+                break
+        else:
+            with results.lock:
+                results.flows += 1
+
+
+def run(flow, users, iterations, ramp_up=0.0):
+    results = Results()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        for i in range(users):
+            pool.submit(run_user, flow, results, iterations)
+            if ramp_up:
+                time.sleep(ramp_up / users)
+    return results.summary(time.perf_counter() - started)
+
+
+def print_summary(summary):
+    print(f"{summary['flows']} flows in {summary['elapsed_seconds']:.1f} s: "
+          f"{summary['flows_per_second']:.2f} flows/s, {summary['requests_per_second']:.2f} req/s")
+    print(f"{'step':<18} {'requests':>8} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for step, s in summary["steps"].items():
+        print(f"{step:<18} {s['requests']:>8} {s['errors']:>6} "
+              f"{s['p50']:>8.3f} {s['p95']:>8.3f} {s['p99']:>8.3f} {s['max']:>8.3f}")
+        for kind, count in s["error_kinds"].items():
+            print(f"{'':<18} {count:>8} x {kind}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=3, help="flows per user")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="seconds over which users start")
+    parser.add_argument("--rows", type=int, default=10000, help="rows in the ion stub's report")
+    parser.add_argument("--country", default="FR")
+    parser.add_argument("--start-date", default="2025-07-01")
+    parser.add_argument("--end-date", default="2025-07-31")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args(argv)
+
+    flow = Flow(args.url, args.rows, args.country, args.start_date, args.end_date, args.timeout)
+    summary = run(flow, args.users, args.iterations, args.ramp_up)
+    print_summary(summary)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# loadtest/ion_stub.py
+"""
+Local stand-in for the ion API used by run_awstool.
+
+    python -m loadtest.ion_stub --port 8081 --rows 50000 --latency 0.2
+
+Serves POST /oauth/token and POST /api/v3/accounts/<id>/reports/<rid>/reportDataCsv.
+The EMEA report (emea_cfg's report id) gets the account -> end customer
+export, every other report id the country export. Payloads are synthetic
+(benchmarks.datagen) unless --payload-dir holds recorded responses named
+<report id>.csv (the CSV that ion returns in "results").
+
+Point the app at it with ION_URL=http://127.0.0.1:8081.
+"""
+import argparse
+import json
+import os
+import re
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks import datagen
+
+
+# emea_cfg["EMEA"]["AWS"] in awstool (not imported: it needs Key Vault at import time)
+EMEA_REPORT_ID = 57273
+REPORT_PATH = re.compile(r"^/api/v3/accounts/\d+/reports/(\d+)/reportDataCsv$")
+
+
+class Payloads:
+    """
+    Report bodies, built once per report id and then served from memory.
+    """
+    def __init__(self, rows, payload_dir=None):
+        self.rows = rows
+        self.payload_dir = payload_dir
+        self.cache = {}
+
+    def get(self, report_id):
+        if report_id not in self.cache:
+            self.cache[report_id] = json.dumps({"results": self._csv(report_id)}).encode("utf-8")
+        return self.cache[report_id]
+
+    def _csv(self, report_id):
+        if self.payload_dir:
+            path = os.path.join(self.payload_dir, f"{report_id}.csv")
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    return f.read()
+        if report_id == EMEA_REPORT_ID:
+            return datagen.ion_emea_report(self.rows).to_csv(index=False)
+        return datagen.ion_country_report(self.rows).to_csv(index=False)
+
+
+def make_handler(payloads, latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            self.rfile.read(length)
+            if latency:
+                time.sleep(latency)
+
+            if self.path == "/oauth/token":
+                body = json.dumps({"access_token": uuid.uuid4().hex,
+                                   "refresh_token": uuid.uuid4().hex}).encode("utf-8")
+                return self._send(200, body)
+
+            match = REPORT_PATH.match(self.path)
+            if match:
+                return self._send(200, payloads.get(int(match.group(1))))
+
+            self._send(404, json.dumps({"error": f"unknown path {self.path}"}).encode("utf-8"))
+
+        def _send(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=8081, rows=10000, latency=0.0, payload_dir=None):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(Payloads(rows, payload_dir), latency))
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rows", type=int, default=10000, help="rows in the synthetic country report")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--payload-dir", help="directory with recorded <report id>.csv payloads")
+    args = parser.parse_args(argv)
+
+    server = serve(args.port, args.rows, args.latency, args.payload_dir)
+    print(f"ion stub listening on http://127.0.0.1:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
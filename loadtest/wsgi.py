@@ -0,0 +1,27 @@
+# loadtest/wsgi.py
+"""
+The Flask app with Key Vault and SQL replaced by local stand-ins, for
+load testing:
+
+    ION_URL=http://127.0.0.1:8081 gunicorn -w 4 -b 127.0.0.1:8000 loadtest.wsgi:app
+
+aws.end_customer lives in the SQLite file LOADTEST_SQLITE (default
+loadtest.sqlite, seeded on first use with the synthetic report's SAP IDs for
+LOADTEST_ROWS rows). Blob Storage is faked in memory unless
+AZURE_STORAGE_CONNECTION_STRING is set, in which case the real client talks
+to it (e.g. Azurite's "UseDevelopmentStorage=true").
+"""
+import os
+
+from benchmarks import datagen, stubs
+
+
+ROWS = int(os.environ.get("LOADTEST_ROWS", 10000))
+
+stubs.install(
+    datagen.end_customer_ids(datagen.billing_report(ROWS)),
+    sqlite_path=os.environ.get("LOADTEST_SQLITE", "loadtest.sqlite"),
+    fake_blob=not os.environ.get("AZURE_STORAGE_CONNECTION_STRING"),
+)
+
+from app import app  # noqa: E402,F401
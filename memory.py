@@ -0,0 +1,232 @@
+# memory.py
+"""
+What a worker keeps between requests, and giving memory back after heavy ones.
+
+Anything a worker holds on to between requests goes in `retained`, a store
+bounded by size (STATE_MAX_MB) and age (STATE_MAX_AGE_SECONDS): the least
+recently used entries are evicted to make room, and entries unused for
+longer than the max age are dropped whenever the store is used and after
+every heavy request. An entry can have an on_evict callback, e.g. to delete
+the files it stands for; while a request is using the entry (see
+Store.using) the callback waits until it is done. Names are "<kind>:<id>",
+and metrics are labelled by kind only.
+
+release() runs when a heavy response has been sent: it drops expired
+entries, collects garbage and asks glibc to return freed heap pages to the
+OS (malloc_trim), so RSS falls back after a large report instead of staying
+at its peak. /metrics reports RSS and retained bytes per worker.
+"""
+import contextlib
+import ctypes
+import ctypes.util
+import gc
+import os
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import metrics
+
+
+MB = 2**20
+
+STATE_MAX_BYTES = int(float(os.environ.get("STATE_MAX_MB", 256)) * MB)
+STATE_MAX_AGE_SECONDS = float(os.environ.get("STATE_MAX_AGE_SECONDS", 3600))
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+    _malloc_trim = _libc.malloc_trim
+except (OSError, AttributeError):  # not glibc: nothing to trim
+    _malloc_trim = None
+
+
+def nbytes(value):
+    """
+    Approximate memory held by a value: deep size for frames and series,
+    summed over lists, tuples and dict values.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(nbytes(item) for item in value.values())
+    return sys.getsizeof(value)
+
+
+class Entry:
+    def __init__(self, value, size, on_evict):
+        self.value = value
+        self.size = size
+        self.on_evict = on_evict
+        self.used_at = time.monotonic()
+        # requests using the value, and whether it left the store meanwhile
+        self.users = 0
+        self.evicted = False
+
+
+class Store:
+    def __init__(self, max_bytes, max_age):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def put(self, name, value, size=None, on_evict=None):
+        """
+        Keep `value` under `name` (replacing any previous one). `size` is
+        what it costs the worker, nbytes(value) by default (for uploads kept
+        on disk, their file size).
+        """
+        entry = Entry(value, nbytes(value) if size is None else size, on_evict)
+        with self._lock:
+            evicted = [(name, self._entries.pop(name), "replaced")] if name in self._entries else []
+            evicted += self._expired()
+            # least recently used first, but the new entry always stays
+            while self._entries and sum(e.size for e in self._entries.values()) + entry.size > self.max_bytes:
+                oldest = min(self._entries, key=lambda key: self._entries[key].used_at)
+                evicted.append((oldest, self._entries.pop(oldest), "size"))
+            self._entries[name] = entry
+        self._evicted(evicted)
+
+    def get(self, name, default=None):
+        with self._lock:
+            evicted = self._expired()
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry.used_at = time.monotonic()
+        self._evicted(evicted)
+        return default if entry is None else entry.value
+
+    @contextlib.contextmanager
+    def using(self, name, default=None):
+        """
+        Like get, but the entry's on_evict callback is held back until the
+        block is done, even if the entry is evicted meanwhile.
+        """
+        with self._lock:
+            evicted = self._expired()
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry.used_at = time.monotonic()
+                entry.users += 1
+        self._evicted(evicted)
+        if entry is None:
+            yield default
+            return
+        try:
+            yield entry.value
+        finally:
+            with self._lock:
+                entry.users -= 1
+                release = entry.evicted and entry.users == 0
+            if release:
+                self._release(name, entry)
+
+    def pop(self, name, default=None):
+        """
+        Remove and return an entry, without its on_evict callback.
+        """
+        with self._lock:
+            entry = self._entries.pop(name, None)
+        return default if entry is None else entry.value
+
+    def discard(self, name):
+        """
+        Drop an entry, running its on_evict callback.
+        """
+        with self._lock:
+            entry = self._entries.pop(name, None)
+        if entry is not None:
+            self._evicted([(name, entry, "released")])
+
+    def expire(self):
+        with self._lock:
+            evicted = self._expired()
+        self._evicted(evicted)
+
+    def _expired(self):
+        # caller holds the lock
+        now = time.monotonic()
+        names = [name for name, entry in self._entries.items() if now - entry.used_at >= self.max_age]
+        return [(name, self._entries.pop(name), "age") for name in names]
+
+    def _evicted(self, evicted):
+        for name, entry, reason in evicted:
+            if reason != "released":
+                metrics.STATE_EVICTIONS.inc(name=name.split(":", 1)[0], reason=reason)
+            with self._lock:
+                entry.evicted = True
+                in_use = entry.users > 0
+            if not in_use:
+                self._release(name, entry)
+
+    def _release(self, name, entry):
+        if entry.on_evict is not None:
+            try:
+                entry.on_evict(entry.value)
+            except Exception as e:
+                print(f"Releasing {name} failed: {e}")
+
+    def retained_bytes(self):
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+retained = Store(STATE_MAX_BYTES, STATE_MAX_AGE_SECONDS)
+
+
+def release():
+    """
+    Give memory back after a heavy request: drop expired state, collect
+    garbage and trim the heap.
+    """
+    retained.expire()
+    gc.collect()
+    if _malloc_trim is not None:
+        _malloc_trim(0)
+
+
+def rss_bytes():
+    """
+    Resident set size of this process, or None where /proc is missing.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def metrics_lines():
+    """
+    RSS and retained state of this worker in the Prometheus text format.
+    """
+    worker = os.getpid()
+    lines = []
+    rss = rss_bytes()
+    if rss is not None:
+        lines += [
+            "# HELP biapp_worker_rss_bytes Resident set size of the worker.",
+            "# TYPE biapp_worker_rss_bytes gauge",
+            f'biapp_worker_rss_bytes{{worker="{worker}"}} {rss}',
+        ]
+    lines += [
+        "# HELP biapp_retained_bytes Bytes the worker keeps between requests.",
+        "# TYPE biapp_retained_bytes gauge",
+        f'biapp_retained_bytes{{worker="{worker}"}} {retained.retained_bytes()}',
+        "# HELP biapp_retained_entries Entries the worker keeps between requests.",
+        "# TYPE biapp_retained_entries gauge",
+        f'biapp_retained_entries{{worker="{worker}"}} {len(retained)}',
+    ]
+    return lines
@@ -0,0 +1,239 @@
+# metrics.py
+"""
+Minimal Prometheus-style metrics: counters and histograms kept in process
+memory and rendered in the text exposition format by /metrics.
+
+Observations only take a lock and bump a few integers, so they are cheap
+enough for the hot paths. Under gunicorn every worker has its own registry;
+set METRICS_DIR to a directory shared by the workers and each one writes a
+snapshot there (at most every METRICS_FLUSH_SECONDS), which /metrics merges.
+"""
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 5))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 5e7, 1e8, 5e8, 1e9)
+
+_registry = []
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {"|".join(key): value for key, value in self._values.items()}
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {"|".join(key): [list(state[0]), state[1], state[2]] for key, state in self._values.items()}
+
+
+# -----------------------
+# Application metrics
+# -----------------------
+REQUEST_LATENCY = Histogram(
+    "biapp_request_duration_seconds", "Request latency per route.", ["route", "method", "status"])
+STAGE_LATENCY = Histogram(
+    "biapp_stage_duration_seconds", "Latency of awstool / X2CF processing stages.", ["stage"])
+DEPENDENCY_LATENCY = Histogram(
+    "biapp_dependency_duration_seconds", "Latency of external dependency calls.",
+    ["dependency", "operation", "outcome"])
+DEPENDENCY_ERRORS = Counter(
+    "biapp_dependency_errors_total", "Failed external dependency calls.", ["dependency", "operation"])
+DEPENDENCY_RETRIES = Counter(
+    "biapp_dependency_retries_total", "Retried external dependency calls.", ["dependency", "operation"])
+CIRCUIT_REJECTED = Counter(
+    "biapp_circuit_rejected_total", "Calls refused by an open circuit breaker.", ["dependency"])
+ROWS = Counter(
+    "biapp_rows_total", "Rows produced by processing stages.", ["stage"])
+PAYLOAD_BYTES = Histogram(
+    "biapp_payload_bytes", "Size of downloaded reports, uploads and Blob payloads.", ["kind"],
+    buckets=SIZE_BUCKETS)
+ADMISSION_WAIT = Histogram(
+    "biapp_admission_wait_seconds", "Time heavy requests waited for memory budget.", ["endpoint"])
+ADMISSION_REJECTED = Counter(
+    "biapp_admission_rejected_total", "Heavy requests refused with 503.", ["endpoint"])
+PREFETCH_LOOKUPS = Counter(
+    "biapp_prefetch_lookups_total", "Lookups of prefetched data.", ["name", "outcome"])
+STATE_EVICTIONS = Counter(
+    "biapp_state_evictions_total", "Worker state evicted by size or age.", ["name", "reason"])
+
+
+def stage(name):
+    """
+    Time a processing stage: `with metrics.stage("merge"): ...`
+    """
+    return STAGE_LATENCY.time(stage=name)
+
+
+@contextmanager
+def dependency(name, operation):
+    """
+    Time a call to an external dependency and count it as an error if the
+    block raises.
+    """
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        DEPENDENCY_LATENCY.observe(time.perf_counter() - started,
+                                   dependency=name, operation=operation, outcome=outcome)
+        if outcome == "error":
+            DEPENDENCY_ERRORS.inc(dependency=name, operation=operation)
+
+
+def rows(stage_name, count):
+    ROWS.inc(count, stage=stage_name)
+
+
+def payload(kind, size):
+    PAYLOAD_BYTES.observe(size, kind=kind)
+
+
+# -----------------------
+# Worker snapshots
+# -----------------------
+_last_flush = 0.0
+
+
+def snapshot():
+    return {metric.name: metric.snapshot() for metric in _registry}
+
+
+def flush(force=False):
+    """
+    Write this worker's snapshot to METRICS_DIR (rate limited).
+    """
+    global _last_flush
+    if not METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < METRICS_FLUSH_SECONDS:
+        return
+    _last_flush = now
+
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"worker-{os.getpid()}.json")
+    # per-thread temporary file: gthread workers flush from several threads
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp, path)
+
+
+def _merged():
+    if not METRICS_DIR:
+        return snapshot()
+
+    flush(force=True)
+    merged = {}
+    for path in glob.glob(os.path.join(METRICS_DIR, "worker-*.json")):
+        try:
+            with open(path) as f:
+                worker = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, values in worker.items():
+            target = merged.setdefault(name, {})
+            for key, value in values.items():
+                if key not in target:
+                    target[key] = value
+                elif isinstance(value, list):
+                    counts, total, count = target[key]
+                    target[key] = [[a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2]]
+                else:
+                    target[key] += value
+    return merged
+
+
+# -----------------------
+# Exposition
+# -----------------------
+def _labels(metric, key, extra=""):
+    values = key.split("|") if metric.labelnames else []
+    pairs = [f'{name}="{value}"' for name, value in zip(metric.labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render(extra_lines=()):
+    """
+    Render every metric in the Prometheus text format.
+    """
+    data = _merged()
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in sorted(data.get(metric.name, {}).items()):
+            if metric.kind == "counter":
+                lines.append(f"{metric.name}{_labels(metric, key)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(metric.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{metric.name}_bucket{_labels(metric, key, le)} {cumulative}")
+            lines.append(f"{metric.name}_sum{_labels(metric, key)} {total}")
+            lines.append(f"{metric.name}_count{_labels(metric, key)} {count}")
+    lines.extend(extra_lines)
+    return "\n".join(lines) + "\n"
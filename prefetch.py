@@ -0,0 +1,214 @@
+# prefetch.py
+"""
+Background prefetching of what every report run needs, so interactive
+requests find it warm: ion access tokens, the rolling EMEA account mapping
+and the end-customer SAP IDs (the jobs themselves live in awstool).
+
+With PREFETCH=1 every worker starts a scheduler thread. The worker holding
+the flock on PREFETCH_DIR/leader.lock runs the jobs; the others keep trying
+to take the lock, which the OS releases when the leader dies. Jobs store
+their results in PREFETCH_DIR (pickles replaced atomically), where every
+worker reads them while they are younger than the caller's max age; older
+or missing entries are fetched live as before. invalidate() bumps a
+generation counter next to the entry, so a job that started before the
+invalidation cannot store its stale result afterwards.
+
+Access tokens stay in Key Vault next to their refresh key, stamped with
+refreshed_at; requests use the stored access key while it is younger than
+TOKEN_MAX_AGE_SECONDS.
+"""
+import os
+import pickle
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines: no scheduler
+    fcntl = None
+
+
+PREFETCH = os.environ.get("PREFETCH") == "1"
+PREFETCH_DIR = os.environ.get("PREFETCH_DIR", os.path.join(tempfile.gettempdir(), "biapp_prefetch"))
+TICK_SECONDS = float(os.environ.get("PREFETCH_TICK_SECONDS", 30))
+TOKEN_MAX_AGE_SECONDS = float(os.environ.get("TOKEN_MAX_AGE_SECONDS", 1800))
+
+
+def fresh_access_key(secret_json):
+    """
+    The stored access key of a Key Vault token secret, or None when it is
+    missing or older than TOKEN_MAX_AGE_SECONDS.
+    """
+    refreshed_at = secret_json.get("refreshed_at")
+    if refreshed_at and time.time() - refreshed_at < TOKEN_MAX_AGE_SECONDS:
+        return secret_json.get("access_key")
+    return None
+
+
+# -----------------------
+# Shared cache
+# -----------------------
+def _path(name):
+    return os.path.join(PREFETCH_DIR, f"{name}.pkl")
+
+
+@contextmanager
+def _locked(name):
+    """
+    Hold the entry's lock across workers (no-op without fcntl).
+    """
+    os.makedirs(PREFETCH_DIR, exist_ok=True)
+    with open(os.path.join(PREFETCH_DIR, f"{name}.lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _generation(name):
+    try:
+        with open(os.path.join(PREFETCH_DIR, f"{name}.gen")) as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def generation(name):
+    """
+    The entry's invalidation count; take it before fetching a value and
+    pass it to store().
+    """
+    with _locked(name):
+        return _generation(name)
+
+
+def store(name, value, generation=None):
+    """
+    Store a value for every worker. With `generation`, the value is dropped
+    when the entry was invalidated since that generation was taken.
+    """
+    os.makedirs(PREFETCH_DIR, exist_ok=True)
+    tmp = f"{_path(name)}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with _locked(name):
+        if generation is not None and _generation(name) != generation:
+            os.remove(tmp)
+            print(f"Dropping prefetched {name}: invalidated while it was fetched")
+            return False
+        os.replace(tmp, _path(name))
+    return True
+
+
+def load(name, max_age):
+    """
+    The stored value if it is younger than max_age seconds, else None.
+    """
+    path = _path(name)
+    try:
+        if time.time() - os.path.getmtime(path) >= max_age:
+            metrics.PREFETCH_LOOKUPS.inc(name=name, outcome="stale")
+            return None
+        with open(path, "rb") as f:
+            value = pickle.load(f)
+    except FileNotFoundError:
+        metrics.PREFETCH_LOOKUPS.inc(name=name, outcome="miss")
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable prefetched {name}: {e}")
+        return None
+    metrics.PREFETCH_LOOKUPS.inc(name=name, outcome="hit")
+    return value
+
+
+def invalidate(name):
+    """
+    Drop a stored value whose source changed (e.g. aws.end_customer), and
+    any value still being fetched from the old source.
+    """
+    with _locked(name):
+        gen_path = os.path.join(PREFETCH_DIR, f"{name}.gen")
+        with open(f"{gen_path}.tmp", "w") as f:
+            f.write(str(_generation(name) + 1))
+        os.replace(f"{gen_path}.tmp", gen_path)
+        try:
+            os.remove(_path(name))
+        except FileNotFoundError:
+            pass
+
+
+# -----------------------
+# Scheduler
+# -----------------------
+class Job:
+    def __init__(self, name, interval, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.last_run = 0.0
+
+
+jobs = []
+_started = False
+
+
+def schedule(name, interval, fn):
+    """
+    Run fn() every `interval` seconds on the leader worker.
+    """
+    jobs.append(Job(name, interval, fn))
+
+
+def _try_lead():
+    """
+    The open leader lock file if this worker got the lock, else None.
+    """
+    os.makedirs(PREFETCH_DIR, exist_ok=True)
+    lock = open(os.path.join(PREFETCH_DIR, "leader.lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    print(f"Worker {os.getpid()} runs the prefetch jobs")
+    return lock
+
+
+def run_due(now=None):
+    now = time.monotonic() if now is None else now
+    for job in jobs:
+        if job.last_run and now - job.last_run < job.interval:
+            continue
+        job.last_run = now
+        try:
+            with metrics.stage(f"prefetch_{job.name}"):
+                job.fn()
+        except Exception:
+            print(f"Prefetch job {job.name} failed:")
+            print(traceback.format_exc())
+
+
+def _loop():
+    lock = None
+    while True:
+        if lock is None:
+            lock = _try_lead()
+        if lock is not None:
+            run_due()
+        time.sleep(TICK_SECONDS)
+
+
+def start():
+    """
+    Start this worker's scheduler thread (once; only with PREFETCH=1).
+    """
+    global _started
+    if not PREFETCH or fcntl is None or _started:
+        return
+    _started = True
+    threading.Thread(target=_loop, name="prefetch", daemon=True).start()
@@ -0,0 +1,129 @@
+# profiling.py
+"""
+Opt-in request profiling: cProfile plus tracemalloc peak memory.
+
+A request is profiled when PROFILE_REQUESTS=1, or when it carries an
+X-Profile-Token header matching PROFILE_TOKEN. The artifacts are written to
+PROFILE_DIR as <request id>.prof (pstats), .txt (top functions) and .json
+(summary), and also uploaded to the PROFILE_CONTAINER Blob container when
+that is set. The request id is returned in the X-Profile-Id header.
+
+Only one request per worker is profiled at a time: tracemalloc is
+process-wide, so a second concurrent profile would report the other
+request's allocations as its own. A request that arrives while another is
+being profiled runs unprofiled.
+"""
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS") == "1"
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_CONTAINER = os.environ.get("PROFILE_CONTAINER")
+
+# Functions listed in the .txt summary
+TOP_FUNCTIONS = 40
+
+# held by the request being profiled
+_active = threading.Lock()
+
+
+def wanted(request):
+    if PROFILE_REQUESTS:
+        return True
+    token = request.headers.get("X-Profile-Token")
+    return bool(PROFILE_TOKEN and token and hmac.compare_digest(token, PROFILE_TOKEN))
+
+
+class RequestProfile:
+    def __init__(self, request):
+        # the id names the artifact files, so only accept a plain token
+        request_id = request.headers.get("X-Request-ID", "")
+        self.request_id = request_id if re.fullmatch(r"[A-Za-z0-9_-]{1,64}", request_id) else uuid.uuid4().hex
+        self.route = request.path
+        self.method = request.method
+        self.profiler = cProfile.Profile()
+        self.started_tracing = False
+        # nothing to stop until start() succeeds
+        self.stopped = True
+
+    def start(self):
+        """
+        Start profiling; returns False, without starting, when another
+        request is already being profiled.
+        """
+        if not _active.acquire(blocking=False):
+            return False
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+            self.started_tracing = True
+        self.stopped = False
+        self.started = time.perf_counter()
+        self.profiler.enable()
+        return True
+
+    def stop(self):
+        """
+        Stop profiling; safe to call more than once.
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        self.profiler.disable()
+        self.seconds = time.perf_counter() - self.started
+        _, self.peak_bytes = tracemalloc.get_traced_memory()
+        if self.started_tracing:
+            tracemalloc.stop()
+        _active.release()
+
+    def save(self, status, blob_service_client=None):
+        """
+        Write the profile artifacts and return their paths.
+        """
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, self.request_id)
+
+        stats = pstats.Stats(self.profiler)
+        stats.dump_stats(base + ".prof")
+
+        text = io.StringIO()
+        pstats.Stats(self.profiler, stream=text).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        with open(base + ".txt", "w") as f:
+            f.write(text.getvalue())
+
+        summary = {
+            "request_id": self.request_id,
+            "route": self.route,
+            "method": self.method,
+            "status": status,
+            "seconds": round(self.seconds, 4),
+            "peak_memory_mb": round(self.peak_bytes / 2**20, 2),
+            "recorded_at": datetime.utcnow().isoformat() + "Z",
+        }
+        with open(base + ".json", "w") as f:
+            json.dump(summary, f, indent=2)
+
+        paths = [base + ext for ext in (".prof", ".txt", ".json")]
+
+        if PROFILE_CONTAINER and blob_service_client is not None:
+            for path in paths:
+                with open(path, "rb") as f:
+                    blob_service_client.get_blob_client(
+                        container=PROFILE_CONTAINER,
+                        blob=f"profiles/{os.path.basename(path)}"
+                    ).upload_blob(f, overwrite=True)
+
+        return paths
@@ -0,0 +1,207 @@
+# resilience.py
+"""
+Timeouts, retries and circuit breakers for the external dependencies: ion,
+Key Vault, the SQL database and Blob storage.
+
+Every call goes through call(dependency, operation, fn): transient failures
+(connection errors, timeouts, 429 / 5xx) are retried up to <NAME>_RETRIES
+times with jittered exponential backoff, and each dependency has a circuit
+breaker. After BREAKER_FAILURES failures in a row the breaker opens and
+calls fail at once with CircuitOpen for BREAKER_RESET_SECONDS; then one
+trial call is let through, which closes the breaker again if it succeeds.
+
+The timeout of a dependency (<NAME>_TIMEOUT seconds) is applied by its
+client: timeout(name) and client_options(name) give the values to pass on.
+Breaker state lives in the worker process and is exported by /metrics.
+"""
+import http.client
+import os
+import random
+import threading
+import time
+
+import metrics
+
+try:
+    from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+except ImportError:
+    HttpResponseError = ServiceRequestError = ServiceResponseError = None
+
+
+# dependency: (timeout seconds, retries). Blob uploads and downloads are
+# retried chunk by chunk by the Azure SDK itself.
+DEFAULTS = {
+    "ion": (120, 2),
+    "keyvault": (10, 2),
+    "sql": (15, 2),
+    "blob": (60, 0),
+}
+
+RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", 0.5))
+RETRY_BACKOFF_MAX = float(os.environ.get("RETRY_BACKOFF_MAX", 10))
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_RESET_SECONDS = float(os.environ.get("BREAKER_RESET_SECONDS", 30))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(RuntimeError):
+    def __init__(self, dependency, retry_in):
+        super().__init__(f"{dependency} is unavailable, not calling it for another {retry_in:.0f} s")
+        self.dependency = dependency
+
+
+class TransientStatus(Exception):
+    """
+    Raised by a call on a retryable HTTP status (429 or 5xx), carrying the
+    response so the caller can still report it once retries run out.
+    """
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.body = body
+
+
+def retryable_status(status):
+    return status == 429 or status >= 500
+
+
+def transient(error):
+    """
+    Whether an error is worth retrying (and counts against the breaker).
+    """
+    if isinstance(error, (TransientStatus, OSError, http.client.HTTPException)):
+        return True
+    if ServiceRequestError is not None:
+        if isinstance(error, (ServiceRequestError, ServiceResponseError)):
+            return True
+        if isinstance(error, HttpResponseError):
+            return retryable_status(error.status_code or 0)
+    return False
+
+
+class Breaker:
+    def __init__(self, dependency):
+        self.dependency = dependency
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raise CircuitOpen unless a call may go through now.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            retry_in = self.opened_at + BREAKER_RESET_SECONDS - time.monotonic()
+            if self.state == OPEN and retry_in <= 0:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return
+        metrics.CIRCUIT_REJECTED.inc(dependency=self.dependency)
+        raise CircuitOpen(self.dependency, max(retry_in, 0))
+
+    def record(self, ok):
+        with self._lock:
+            self.trial_running = False
+            if ok:
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= BREAKER_FAILURES:
+                if self.state != OPEN:
+                    print(f"Circuit for {self.dependency} opened after {self.failures} failures")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures}
+
+
+class Policy:
+    def __init__(self, dependency, timeout, retries):
+        prefix = dependency.upper()
+        self.timeout = float(os.environ.get(f"{prefix}_TIMEOUT", timeout))
+        self.retries = int(os.environ.get(f"{prefix}_RETRIES", retries))
+        self.breaker = Breaker(dependency)
+
+
+policies = {name: Policy(name, timeout, retries) for name, (timeout, retries) in DEFAULTS.items()}
+
+
+def timeout(dependency):
+    return policies[dependency].timeout
+
+
+def client_options(dependency):
+    """
+    Keyword arguments for an Azure SDK client of the dependency: its timeout,
+    and no SDK retries when call() does the retrying.
+    """
+    policy = policies[dependency]
+    options = {"connection_timeout": policy.timeout, "read_timeout": policy.timeout}
+    if policy.retries:
+        options["retry_total"] = 0
+    return options
+
+
+def backoff_delay(attempt, backoff=None):
+    """
+    Sleep before retry `attempt` (0-based): exponential, capped, with the
+    upper half randomized so retrying workers spread out.
+    """
+    delay = min(RETRY_BACKOFF_MAX, (RETRY_BACKOFF if backoff is None else backoff) * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def call(dependency, operation, fn, *args, retries=None, backoff=None, retry_on=(), **kwargs):
+    """
+    Call fn(*args, **kwargs) under the dependency's breaker, timing every
+    attempt as a dependency metric. Transient errors (and `retry_on`
+    exceptions) are retried; retries=0 for calls that must not be repeated.
+    """
+    policy = policies[dependency]
+    retries = policy.retries if retries is None else retries
+
+    for attempt in range(retries + 1):
+        policy.breaker.before_call()
+        try:
+            with metrics.dependency(dependency, operation):
+                result = fn(*args, **kwargs)
+        except Exception as e:
+            failed = transient(e) or isinstance(e, retry_on)
+            # a non-transient error (bad request, missing secret) says nothing about availability
+            policy.breaker.record(not failed)
+            if not failed or attempt == retries:
+                raise
+            metrics.DEPENDENCY_RETRIES.inc(dependency=dependency, operation=operation)
+            time.sleep(backoff_delay(attempt, backoff))
+        else:
+            policy.breaker.record(True)
+            return result
+
+
+def metrics_lines():
+    """
+    Breaker state of this worker in the Prometheus text format.
+    """
+    worker = os.getpid()
+    lines = [
+        "# HELP biapp_circuit_state Circuit breaker state per dependency (0 closed, 1 half open, 2 open).",
+        "# TYPE biapp_circuit_state gauge",
+    ]
+    states = {name: policy.breaker.snapshot() for name, policy in policies.items()}
+    for name, state in states.items():
+        lines.append(f'biapp_circuit_state{{dependency="{name}",worker="{worker}"}} {STATE_VALUES[state["state"]]}')
+    lines.append("# HELP biapp_circuit_failures Consecutive failures per dependency.")
+    lines.append("# TYPE biapp_circuit_failures gauge")
+    for name, state in states.items():
+        lines.append(f'biapp_circuit_failures{{dependency="{name}",worker="{worker}"}} {state["failures"]}')
+    return lines
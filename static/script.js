@@ -1,4 +1,6 @@
 let allColumns = [];
+// token of the upload, sent back to /process
+let uploadId = null;
 
 // hide everything initially
 ['select-columns-container',
@@ -12,15 +14,23 @@ let allColumns = [];
 document.getElementById('upload-form').addEventListener('submit', e => {
   e.preventDefault();
   const form = new FormData(e.target);
+  if (uploadId) form.append('upload_id', uploadId);
   document.getElementById('loading').style.display = 'block';
 
   fetch('/x2cf_upload_file', {
     method: 'POST',
     body: form
   })
-  .then(r => r.json())
-  .then(cols => {
-    allColumns = cols.sort();
+  .then(r => r.json().then(data => {
+    if (!r.ok) {
+      const details = (data.files || []).map(f => `${f.filename}: ${f.error}`).join('\n');
+      throw new Error([data.error || 'Unknown', details].filter(Boolean).join('\n'));
+    }
+    return data;
+  }))
+  .then(data => {
+    uploadId = data.upload_id;
+    allColumns = data.columns.sort();
     const cont = document.getElementById('columns-container');
     cont.innerHTML = '';
     allColumns.forEach(c => addCheckbox(cont, 'columns', c));
@@ -66,6 +76,7 @@ document.getElementById('confirm-columns').addEventListener('click', e => {
 document.getElementById('process-button').addEventListener('click', e => {
   e.preventDefault();
   const form = new URLSearchParams();
+  form.append('upload_id', uploadId);
 
   document.querySelectorAll('input[type="checkbox"]:checked').forEach(cb => {
     form.append(cb.name, cb.value);
@@ -73,6 +84,9 @@ document.getElementById('process-button').addEventListener('click', e => {
 
   form.append('order_by', document.getElementById('order_by').value);
 
+  const outputFormat = document.getElementById('output_format').value;
+  form.append('format', outputFormat);
+
   Array.from(document.getElementById('column_order').children)
     .map(li => li.dataset.value)
     .forEach(col => form.append('column_order', col));
@@ -93,7 +107,7 @@ document.getElementById('process-button').addEventListener('click', e => {
     const url = URL.createObjectURL(blob);
     const a = document.createElement('a');
     a.href = url;
-    a.download = 'grouped_data.xlsx';
+    a.download = `grouped_data.${outputFormat}`;
     document.body.appendChild(a);
     a.click();
     a.remove();
@@ -0,0 +1,41 @@
+# tests/conftest.py
+"""
+The tests run offline against the benchmark stand-ins for Key Vault, Blob
+Storage and the SQL database, in a temporary working directory.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import datagen, stubs  # noqa: E402
+
+stubs.install()
+
+import awstool  # noqa: E402
+
+
+METADATA = {"country": "FR", "start_date": "2025-07-01", "end_date": "2025-07-31"}
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """
+    A working directory holding metadata.json and a fetched 5000-row report;
+    returns the report as datagen built it.
+    """
+    monkeypatch.chdir(tmp_path)
+    report = datagen.billing_report(5000)
+    stubs.END_CUSTOMER_IDS[:] = datagen.end_customer_ids(report)
+    report.to_csv(awstool.report_csv, index=False)
+    with open("metadata.json", "w") as f:
+        json.dump(METADATA, f)
+    return report
+
+
+def check(result):
+    assert "error" not in result, result["error"]
+    return result
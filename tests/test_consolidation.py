@@ -0,0 +1,30 @@
+# tests/test_consolidation.py
+from benchmarks import datagen
+
+import awstool
+from conftest import check
+
+
+def adjust(report):
+    rows = datagen.adjustment_rows(len(report))
+    check(awstool.apply_exception(datagen.to_upload(datagen.exceptions(report, rows), "exceptions.csv")))
+    check(awstool.apply_credit_adjustments(datagen.to_upload(datagen.credits(report, rows), "credits.csv")))
+    check(awstool.apply_po_adjustments(datagen.to_upload(datagen.po_numbers(report, rows), "po.csv")))
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_incremental_consolidation_matches_full_recompute(workspace):
+    check(awstool.consolidation())
+    adjust(workspace)
+    incremental = check(awstool.consolidation())
+    incremental_csv = read(awstool.report_csv)
+
+    awstool.reset_consolidation()
+    full = check(awstool.consolidation())
+
+    assert read(awstool.report_csv) == incremental_csv
+    assert (incremental["seller_sum"], incremental["customer_sum"]) == (full["seller_sum"], full["customer_sum"])
@@ -0,0 +1,76 @@
+# tests/test_consolidation_sql.py
+import re
+
+import pandas as pd
+import pytest
+from benchmarks import datagen, stubs
+
+import awstool
+
+consolidation_sql = pytest.importorskip("consolidation_sql")
+pytest.importorskip("duckdb")
+
+START, END = "2025-07-01", "2025-07-31"
+
+
+@pytest.fixture
+def report():
+    report = datagen.billing_report(5000)
+    report.loc[report.sample(frac=0.05, random_state=1).index, "Materials"] = None
+    return report
+
+
+def end_customers(report):
+    stubs.END_CUSTOMER_IDS[:] = datagen.end_customer_ids(report)
+    return awstool.query_end_customer_ids()
+
+
+def with_po(report):
+    """
+    The report after a PO upload: some rows with a PO, the others missing.
+    """
+    po = pd.Series([f"PO-{i % 7:06d}" for i in range(len(report))], index=report.index)
+    return report.assign(PO=po.where(report.index % 3 == 0))
+
+
+def pandas_groups(path, consolidation_unique):
+    report = awstool.load_report(path)
+    return awstool.group_consolidation(awstool.prepare_consolidation(report, consolidation_unique, START, END))
+
+
+def sql_groups(source, consolidation_unique):
+    return consolidation_sql.group_report(
+        source, consolidation_unique, awstool.billing_period(START, END), awstool.material_ids
+    )
+
+
+def assert_same_groups(report, tmp_path):
+    path = str(tmp_path / "report.csv")
+    awstool.save_report(report, path)
+    consolidation_unique = end_customers(report)
+    expected = pandas_groups(path, consolidation_unique)
+
+    # the CSV path, as consolidation passes it, and a frame from load_report
+    for source in (path, awstool.load_report(path)):
+        pd.testing.assert_frame_equal(sql_groups(source, consolidation_unique), expected, check_dtype=False)
+
+    return expected
+
+
+def test_sql_groups_match_pandas(report, tmp_path):
+    assert_same_groups(report, tmp_path)
+
+
+def test_sql_groups_match_pandas_with_po(report, tmp_path):
+    groups = assert_same_groups(with_po(report), tmp_path)
+    assert (groups["PO"] != "NaN").any()
+
+
+def test_sql_groups_match_pandas_with_material_rules(report, tmp_path, monkeypatch):
+    rules = [("compute", 100001), ("^amazon s", 100002), ("lambda|cloudfront", 100003)]
+    monkeypatch.setattr(
+        awstool, "compiled_material_rules",
+        [(re.compile(pattern, re.IGNORECASE), material) for pattern, material in rules]
+    )
+    groups = assert_same_groups(with_po(report), tmp_path)
+    assert {100001, 100002, 100003, awstool.DEFAULT_MATERIAL_ID} <= set(groups["Material_id"])
@@ -0,0 +1,121 @@
+# tests/test_credits.py
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks import datagen
+
+import awstool
+from conftest import check
+
+
+def old_credit_loop(report, credit_df):
+    """
+    The row by row credit loop credit_adjust replaced. It runs on whole cents
+    (as floats): on float amounts a credit that should be used up can leave
+    a residue of 1e-14 and go on deducting from later rows.
+    """
+    report = report.copy()
+    credit_df = credit_df.copy()
+    for column in awstool.MONEY_COLUMNS:
+        report[column] = (report[column] * 100).round()
+    credit_df['Credit'] = (credit_df['Credit'] * 100).round()
+    for _, credit_row in credit_df.iterrows():
+        credit_amount_seller = credit_row['Credit']
+        credit_amount_customer = credit_row['Credit']
+        for idx in report.index[report['Account'] == credit_row['Account']]:
+            if credit_amount_seller > 0:
+                deduction = min(report.at[idx, 'Seller Cost'], credit_amount_seller)
+                report.at[idx, 'Seller Cost'] -= deduction
+                credit_amount_seller -= deduction
+            if credit_amount_customer > 0:
+                deduction = min(report.at[idx, 'Customer Cost'], credit_amount_customer)
+                report.at[idx, 'Customer Cost'] -= deduction
+                credit_amount_customer -= deduction
+            if credit_amount_seller <= 0 and credit_amount_customer <= 0:
+                break
+    for column in awstool.MONEY_COLUMNS:
+        report[column] = report[column] / 100
+    return report
+
+
+def new_credit_adjust(report, credit_df):
+    # as load_report keeps it: int64 account keys and cents
+    report = report.assign(Account=awstool.to_key(report['Account']))
+    for column in awstool.MONEY_COLUMNS:
+        report[column] = awstool.to_cents(report[column])
+    report, _ = awstool.credit_adjust(report, credit_df)
+    for column in awstool.MONEY_COLUMNS:
+        report[column] = awstool.from_cents(report[column])
+    return report
+
+
+def assert_same_costs(expected, actual):
+    for column in awstool.MONEY_COLUMNS:
+        np.testing.assert_allclose(
+            actual[column].to_numpy("float64"), expected[column].to_numpy("float64"),
+            atol=1e-9, err_msg=column
+        )
+
+
+def account(i):
+    return str(i).zfill(12)
+
+
+def test_credit_matches_old_loop_with_negative_and_missing_costs():
+    report = pd.DataFrame({
+        "Account": [account(i) for i in (1, 1, 1, 2, 2, 2, 3, 3, 4)],
+        "SAP_ID": [10, 10, 10, 20, 20, 20, 30, 30, 40],
+        # account 1 has a negative cost in the middle, account 2 a missing one
+        "Seller Cost": [5.0, -3.25, 10.0, 4.0, np.nan, 6.0, 1.5, 2.5, 7.0],
+        "Customer Cost": [6.0, 2.0, -1.0, np.nan, 3.0, 6.5, 1.75, 2.5, 8.0],
+    })
+    credit_df = pd.DataFrame({
+        "Account": [account(i) for i in (1, 2, 3, 3, 4, 5)],
+        # account 3 has two credits, account 4 a negative one, account 5 no rows
+        "Credit": [9.5, 2.0, 1.0, 2.25, -4.0, 3.0],
+    })
+    assert_same_costs(old_credit_loop(report, credit_df), new_credit_adjust(report, credit_df))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_credit_matches_old_loop_on_random_reports(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(10):
+        rows = int(rng.integers(1, 60))
+        accounts = rng.integers(1, 6, rows)
+        seller = rng.integers(-500, 3000, rows) / 100
+        customer = np.abs(rng.integers(-500, 3000, rows) / 100)
+        customer[rng.random(rows) < 0.05] = np.nan
+        report = pd.DataFrame({
+            "Account": [account(i) for i in accounts],
+            "SAP_ID": accounts * 10,
+            "Seller Cost": seller,
+            "Customer Cost": customer,
+        })
+        credit_df = pd.DataFrame({
+            "Account": [account(i) for i in rng.integers(1, 7, 4)],
+            "Credit": rng.integers(-2000, 8000, 4) / 100,
+        })
+        assert_same_costs(old_credit_loop(report, credit_df), new_credit_adjust(report, credit_df))
+
+
+def test_consolidated_csv_matches_old_loop(workspace):
+    credit_df = datagen.credits(workspace, 40)
+    # a second credit for an account and a negative one
+    credit_df.loc[len(credit_df)] = [credit_df["Account"].iloc[0], 25.0]
+    credit_df.loc[len(credit_df)] = [credit_df["Account"].iloc[1], -10.0]
+
+    check(awstool.apply_credit_adjustments(datagen.to_upload(credit_df, "credits.csv")))
+    adjusted = check(awstool.consolidation())
+    with open(awstool.report_csv, "rb") as f:
+        adjusted_csv = f.read()
+
+    # the report as the old loop left it, consolidated from scratch
+    old = old_credit_loop(workspace, credit_df)
+    old.to_csv(awstool.report_csv, index=False)
+    awstool.reset_consolidation(keep_detail=False)
+    expected = check(awstool.consolidation())
+
+    with open(awstool.report_csv, "rb") as f:
+        assert f.read() == adjusted_csv
+    assert (adjusted["seller_sum"], adjusted["customer_sum"]) == (expected["seller_sum"], expected["customer_sum"])
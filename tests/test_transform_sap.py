@@ -0,0 +1,87 @@
+# tests/test_transform_sap.py
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks import datagen
+
+from app import transform_sap
+
+# transform_sap (and the old loop) use DataFrame.applymap
+pytestmark = pytest.mark.filterwarnings("ignore:DataFrame.applymap:FutureWarning")
+
+
+def old_transform_sap(df):
+    """
+    transform_sap before the stable sort: each header followed by its lines,
+    looked up one header at a time.
+    """
+    def smart_quote(val):
+        val_str = str(val)
+        return f'"{val_str}"' if ',' in val_str else val_str
+
+    df[["Sale Price", "Cost Price"]] = df[["Sale Price", "Cost Price"]].apply(pd.to_numeric, errors="coerce").round(2)
+
+    header_df = df.iloc[:, :10].drop_duplicates().reset_index(drop=True)
+
+    dup_ids = header_df["Header ID"][header_df["Header ID"].duplicated()].unique()
+    if len(dup_ids) > 0:
+        raise ValueError(f"Invalid file. Different header with same ID: {list(dup_ids)}")
+
+    line_df = df.iloc[:, 10:].copy()
+
+    header_df.rename(columns={"Header ID": "ID"}, inplace=True)
+    line_df.rename(columns={"Line ID": "ID"}, inplace=True)
+
+    header_df.insert(0, "Type", "H")
+    line_df.insert(0, "Type", "L")
+
+    header_df["merged"] = header_df.drop(columns="ID").fillna("").applymap(smart_quote).agg(";".join, axis=1)
+    line_df["merged"] = line_df.drop(columns="ID").fillna("").applymap(smart_quote).agg(";".join, axis=1)
+
+    header_out = header_df[["ID", "merged"]]
+    line_out = line_df[["ID", "merged"]]
+
+    rows = []
+    for _, hdr in header_out.iterrows():
+        rows.append(hdr.to_dict())
+        matching = line_out[line_out["ID"] == hdr["ID"]]
+        for _, ln in matching.iterrows():
+            rows.append(ln.to_dict())
+
+    return pd.DataFrame(rows, columns=["merged"])
+
+
+def assert_same_file(df):
+    assert transform_sap(df.copy())["merged"].tolist() == old_transform_sap(df.copy())["merged"].tolist()
+
+
+def test_transform_sap_matches_old_loop():
+    assert_same_file(datagen.sap_workbook(2000))
+
+
+def test_transform_sap_matches_old_loop_with_interleaved_lines():
+    # lines of a header spread over the file, headers out of order
+    df = datagen.sap_workbook(1000, lines_per_header=4)
+    assert_same_file(df.sample(frac=1, random_state=1).reset_index(drop=True))
+
+
+def test_transform_sap_matches_old_loop_on_irregular_rows():
+    df = datagen.sap_workbook(300, lines_per_header=3).astype(object)
+    rng = np.random.default_rng(2)
+    # missing and non-numeric prices, commas in line cells
+    df.loc[rng.choice(len(df), 20, replace=False), "Sale Price"] = np.nan
+    df.loc[rng.choice(len(df), 20, replace=False), "Cost Price"] = "n/a"
+    df.loc[rng.choice(len(df), 20, replace=False), "Description"] = "Storage, Requests"
+    # lines without a header, and rows without a header or line ID
+    df.loc[rng.choice(len(df), 10, replace=False), "Line ID"] = "999999"
+    df.loc[rng.choice(len(df), 10, replace=False), "Line ID"] = np.nan
+    df.loc[df.index[-3:], "Header ID"] = np.nan
+    assert_same_file(df)
+
+
+def test_transform_sap_rejects_conflicting_headers_like_old_loop():
+    df = datagen.sap_workbook(10, lines_per_header=5)
+    df.loc[0, "Customer PO"] = "other"
+    for transform in (transform_sap, old_transform_sap):
+        with pytest.raises(ValueError, match="Different header with same ID"):
+            transform(df.copy())
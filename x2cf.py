@@ -0,0 +1,263 @@
+# x2cf.py
+import csv
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from openpyxl import Workbook
+
+
+# Upper bound on worker processes used to parse one batch of uploads.
+PARSE_WORKERS = int(os.environ.get("X2CF_PARSE_WORKERS", 4))
+
+# Worker processes are started by a forkserver, not forked from the gunicorn
+# worker: that one runs several threads (gthread, prefetch), and a child
+# forked while another thread holds a lock can deadlock on it.
+if "forkserver" in multiprocessing.get_all_start_methods():
+    POOL_CONTEXT = multiprocessing.get_context("forkserver")
+    POOL_CONTEXT.set_forkserver_preload(["x2cf"])
+else:
+    POOL_CONTEXT = multiprocessing.get_context("spawn")
+
+# Account columns must stay strings to keep their leading zeros.
+ACCOUNT_DTYPES = {"Payer Account ID": "string", "Cloud Account Number": "string"}
+
+# Rows read per CSV chunk when parsing and aggregating uploads.
+CHUNK_ROWS = int(os.environ.get("X2CF_CHUNK_ROWS", 200000))
+
+# Rows converted per block when streaming output, so only one block of
+# Python objects is alive at a time.
+OUTPUT_CHUNK_ROWS = 10000
+
+# -----------------------
+# Output formats
+# -----------------------
+output_formats = {
+    "xlsx": {
+        "mimetype": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "download_name": "grouped_data.xlsx",
+    },
+    "csv": {
+        "mimetype": "text/csv",
+        "download_name": "grouped_data.csv",
+    },
+    "parquet": {
+        "mimetype": "application/vnd.apache.parquet",
+        "download_name": "grouped_data.parquet",
+    },
+}
+
+
+def _row_blocks(df):
+    """
+    Yield the frame as lists of row tuples, one block at a time, with
+    missing values turned into None.
+    """
+    for start in range(0, len(df), OUTPUT_CHUNK_ROWS):
+        block = df.iloc[start:start + OUTPUT_CHUNK_ROWS]
+        block = block.astype(object).where(block.notna(), None)
+        yield list(block.itertuples(index=False, name=None))
+
+
+def write_xlsx(df):
+    """
+    Write the frame to a temporary xlsx file with openpyxl's write-only
+    workbook, which streams rows to disk instead of building every cell
+    object in memory.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append([str(c) for c in df.columns])
+    for rows in _row_blocks(df):
+        for row in rows:
+            ws.append(row)
+
+    output = tempfile.TemporaryFile()
+    wb.save(output)
+    output.seek(0)
+    return output
+
+
+def iter_csv(df):
+    """
+    Yield the frame as CSV text, one block of rows at a time.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(df.columns)
+    for rows in _row_blocks(df):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def write_parquet(df):
+    """
+    Write the frame to a temporary Parquet file (requires pyarrow).
+    """
+    output = tempfile.TemporaryFile()
+    df.to_parquet(output, index=False)
+    output.seek(0)
+    return output
+
+
+# -----------------------
+# Uploaded sources
+# -----------------------
+# Uploads are kept on disk and only parsed when needed, so /process can read
+# them chunk by chunk instead of holding every frame in memory.
+UPLOAD_DIR = os.environ.get("X2CF_UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "x2cf_uploads"))
+
+
+def is_supported(filename):
+    return filename.endswith(".csv") or filename.endswith(".xlsx")
+
+
+def save_upload(file):
+    """
+    Store an uploaded file under UPLOAD_DIR and describe it as a source.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    ext = os.path.splitext(file.filename)[1]
+    path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}{ext}")
+    file.save(path)
+    return {"filename": file.filename, "path": path, "country": file.filename[:2].upper()}
+
+
+def discard_sources(sources):
+    for source in sources:
+        try:
+            os.remove(source["path"])
+        except OSError:
+            pass
+
+
+def read_chunks(source, chunksize=None, columns=None):
+    """
+    Yield the source as DataFrames tagged with 'Created Country'. CSV files
+    are read `chunksize` rows at a time; xlsx files are read in one go.
+    When `columns` is given only those columns are parsed.
+    """
+    usecols = None if columns is None else (lambda col: col in columns)
+    if source["filename"].endswith(".csv"):
+        chunks = pd.read_csv(source["path"], usecols=usecols, dtype=ACCOUNT_DTYPES, chunksize=chunksize)
+        if chunksize is None:
+            chunks = [chunks]
+    else:
+        chunks = [pd.read_excel(source["path"], usecols=usecols, dtype=ACCOUNT_DTYPES)]
+
+    for chunk in chunks:
+        chunk["Created Country"] = source["country"]
+        yield chunk
+
+
+def map_sources(fn, sources, *args, processes=True):
+    """
+    Run fn(source, *args) for every source in a bounded process pool, or
+    in this process with processes=False (for cheap calls, which would not
+    pay for starting workers). Returns one result dict per source, in
+    upload order, holding either the value fn returned or the error it
+    raised.
+    """
+    results = [{"filename": source["filename"]} for source in sources]
+
+    def collect(result, call):
+        try:
+            result["value"] = call()
+        except Exception as e:
+            result["error"] = str(e)
+
+    if not processes or len(sources) <= 1:
+        for result, source in zip(results, sources):
+            collect(result, lambda: fn(source, *args))
+        return results
+
+    with ProcessPoolExecutor(max_workers=min(PARSE_WORKERS, len(sources)), mp_context=POOL_CONTEXT) as pool:
+        futures = [pool.submit(fn, source, *args) for source in sources]
+        for result, future in zip(results, futures):
+            collect(result, future.result)
+
+    return results
+
+
+# -----------------------
+# Upload parsing
+# -----------------------
+def read_header(source, preview_rows=0):
+    """
+    Read only the header (plus `preview_rows` rows) of one uploaded file and
+    report its columns, preview and read time.
+    """
+    started = time.perf_counter()
+    if source["filename"].endswith(".csv"):
+        preview = pd.read_csv(source["path"], nrows=preview_rows, dtype=ACCOUNT_DTYPES)
+    else:
+        preview = pd.read_excel(source["path"], nrows=preview_rows, dtype=ACCOUNT_DTYPES)
+    preview["Created Country"] = source["country"]
+
+    return {
+        "columns": preview.columns.tolist(),
+        "preview": preview.astype(object).where(preview.notna(), None).to_dict(orient="records"),
+        "seconds": time.perf_counter() - started,
+    }
+
+
+# -----------------------
+# Chunked aggregation
+# -----------------------
+def partial_aggregate(source, group_by, sum_columns):
+    """
+    Group sums for one source, computed chunk by chunk on categorical keys.
+    Runs inside a worker process.
+    """
+    partials = []
+    for chunk in read_chunks(source, CHUNK_ROWS, columns=set(group_by + sum_columns)):
+        # a file without one of the group columns has no complete keys
+        if any(col not in chunk.columns for col in group_by):
+            continue
+        chunk = chunk.reindex(columns=group_by + sum_columns)
+        for col in group_by:
+            chunk[col] = chunk[col].astype("category")
+        partial = chunk.groupby(group_by, observed=True, sort=False)[sum_columns].sum().reset_index()
+        # back to plain dtypes: categories from different chunks do not line up
+        for col in group_by:
+            partial[col] = partial[col].astype(partial[col].cat.categories.dtype)
+        partials.append(partial)
+
+    if not partials:
+        return None
+    return merge_partials(partials, group_by, sum_columns, sort=False)
+
+
+def merge_partials(partials, group_by, sum_columns, sort=True):
+    """
+    Combine partial group sums into one set of group sums.
+    """
+    combined = pd.concat(partials, ignore_index=True)
+    return combined.groupby(group_by, sort=sort)[sum_columns].sum().reset_index()
+
+
+def aggregate(sources, group_by, agg_dict):
+    """
+    Sum the agg_dict columns per group_by across every source without
+    concatenating the sources. Returns the grouped frame and any per-file
+    errors.
+    """
+    sum_columns = [col for col, agg in agg_dict.items() if agg == "sum"]
+    results = map_sources(partial_aggregate, sources, group_by, sum_columns)
+
+    errors = [{"filename": r["filename"], "error": r["error"]} for r in results if "error" in r]
+    partials = [r["value"] for r in results if r.get("value") is not None]
+    if errors:
+        return None, errors
+
+    if not partials:
+        return pd.DataFrame(columns=group_by + sum_columns), []
+    return merge_partials(partials, group_by, sum_columns), []